@@ -1,24 +1,47 @@
 #!/usr/bin/env python
 
+import abc
 import argparse
+import atexit
+import hashlib
+import httpx
 import os
+import platform
+import queue
+import subprocess
 import sys
 import asyncio
+import codecs
+import contextlib
+import copy
 import json
+import mmap
+import multiprocessing
 import socketio
-import tempfile
+import stat
+import struct
 import threading
+import time
 import uuid
+import zlib
+from collections import OrderedDict, deque
+from datetime import datetime
 from pathlib import Path
-from typing import Dict, Optional, Any, Coroutine
+from typing import Dict, List, Optional, Any, Coroutine
+from urllib.parse import urlparse
 from aider import models, utils
+from aider import commands as aider_commands
+from aider import run_cmd as aider_run_cmd
+from aider.coders import base_coder as aider_base_coder
 from aider.coders import Coder
 from aider.commands import Commands
+from aider.history import ChatSummary
 from aider.io import InputOutput, AutoCompleter
+from aider.repomap import RepoMap
 from aider.watch import FileWatcher
 from aider.main import main as cli_main
 from aider.utils import is_image_file
-from concurrent.futures import ThreadPoolExecutor, Future
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
 import nest_asyncio
 import litellm
 import types
@@ -28,9 +51,299 @@ class PromptContext:
     self.id = id
     self.group = group
 
+class SessionHistory:
+  """Append-only chat history of a single session.
+
+  Message IDs are their positions in the history, so the version of the history
+  is simply the number of messages it holds. Every version has a content hash
+  chained from the previous one:
+
+    hash(0) = ""
+    hash(n + 1) = sha256(hash(n) + NUL + role + NUL + content)
+  """
+
+  def __init__(self):
+    self.messages: List[Dict[str, str]] = []
+    self.hashes: List[str] = [""]
+
+  @property
+  def version(self):
+    return len(self.messages)
+
+  @property
+  def hash(self):
+    return self.hashes[-1]
+
+  def append(self, messages):
+    for msg in messages:
+      role = msg['role']
+      content = msg['content']
+      digest = hashlib.sha256(f"{self.hashes[-1]}\0{role}\0{content}".encode("utf-8", "surrogatepass")).hexdigest()
+      self.messages.append(dict(role=role, content=content))
+      self.hashes.append(digest)
+
+class SessionHistoryStore:
+  """Keeps the chat history of recent sessions, so the UI only needs to send new messages."""
+
+  def __init__(self, max_sessions=16):
+    self.max_sessions = max_sessions
+    self.sessions: "OrderedDict[str, SessionHistory]" = OrderedDict()
+
+  def get(self, session_id) -> Optional[SessionHistory]:
+    history = self.sessions.get(session_id)
+    if history is not None:
+      self.sessions.move_to_end(session_id)
+    return history
+
+  def replace(self, session_id, messages) -> SessionHistory:
+    """Full resync: replaces the stored history of the session."""
+    history = SessionHistory()
+    history.append(messages)
+    self.sessions[session_id] = history
+    self.sessions.move_to_end(session_id)
+    while len(self.sessions) > self.max_sessions:
+      self.sessions.popitem(last=False)
+    return history
+
+  def extend(self, session_id, base_version, base_hash, messages) -> Optional[SessionHistory]:
+    """Appends new messages on top of the given base. Returns None when a full resync is needed."""
+    history = self.get(session_id)
+    if history is None:
+      return None
+    # the base comes from the UI, anything but a known version needs a full resync
+    if not isinstance(base_version, int) or isinstance(base_version, bool) or not 0 <= base_version <= history.version:
+      return None
+    if history.hashes[base_version] != base_hash:
+      return None
+
+    if base_version < history.version:
+      # the UI is based on an older version (e.g. last message was edited or removed)
+      del history.messages[base_version:]
+      del history.hashes[base_version + 1:]
+
+    history.append(messages)
+    return history
+
+class RepoFilesCache:
+  """
+  Repository file listing shared by all coders.
+
+  The listing is invalidated when git HEAD, the git index or the aider ignore file change,
+  and explicitly on file watcher events.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.state = None
+    self.relative_files = None
+    self.abs_files = None
+
+  def invalidate(self):
+    with self.lock:
+      self.state = None
+      self.relative_files = None
+      self.abs_files = None
+
+  def get_state(self, coder):
+    repo = coder.repo
+    try:
+      git_dir = repo.repo.git_dir
+      head = repo.repo.head.commit.hexsha if repo.repo.head.is_valid() else None
+    except Exception:
+      return None
+
+    def stat_key(path):
+      try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+      except (OSError, TypeError):
+        return None
+
+    return (
+      coder.root,
+      head,
+      stat_key(os.path.join(git_dir, "index")),
+      stat_key(repo.aider_ignore_file),
+    )
+
+  def _get_cached_files(self, coder, load_files):
+    state = self.get_state(coder) if coder.repo else None
+    if state is None:
+      return None, load_files()
+
+    with self.lock:
+      if self.state == state and self.relative_files is not None:
+        return state, self.relative_files
+
+    relative_files = load_files()
+    with self.lock:
+      self.state = state
+      self.relative_files = relative_files
+      self.abs_files = None
+    return state, relative_files
+
+  def get_relative_files(self, coder, load_files):
+    _, relative_files = self._get_cached_files(coder, load_files)
+    return list(relative_files)
+
+  def get_abs_files(self, coder, load_files):
+    state, relative_files = self._get_cached_files(coder, load_files)
+    if state is not None:
+      with self.lock:
+        if self.state == state and self.abs_files is not None:
+          return list(self.abs_files)
+
+    abs_files = [coder.abs_root_path(path) for path in relative_files]
+    if state is not None:
+      with self.lock:
+        if self.state == state:
+          self.abs_files = abs_files
+    return list(abs_files)
+
+class ConnectorMetrics:
+  """Simple in-process metrics, sent to AiderDesk on request-metrics action."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.counters: Dict[str, float] = {}
+    self.gauges: Dict[str, Any] = {}
+    self.timings: Dict[str, Dict[str, float]] = {}
+
+  def increment(self, name, value=1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  def set_gauge(self, name, value):
+    with self.lock:
+      if value is None:
+        self.gauges.pop(name, None)
+      else:
+        self.gauges[name] = value
+
+  def record_timing(self, name, duration_ms):
+    with self.lock:
+      timing = self.timings.get(name)
+      if timing is None:
+        timing = self.timings[name] = {"count": 0, "total": 0.0, "min": duration_ms, "max": duration_ms, "last": duration_ms}
+      timing["count"] += 1
+      timing["total"] += duration_ms
+      timing["min"] = min(timing["min"], duration_ms)
+      timing["max"] = max(timing["max"], duration_ms)
+      timing["last"] = duration_ms
+
+  def snapshot(self):
+    with self.lock:
+      return {
+        "counters": dict(self.counters),
+        "gauges": dict(self.gauges),
+        "timings": {
+          name: dict(timing, avg=timing["total"] / timing["count"]) for name, timing in self.timings.items()
+        },
+      }
+
+class FileContentCache:
+  """
+  Process-wide cache of text file contents, shared by the IO of all coders.
+
+  Files are looked up by path and validated by mtime, size and inode. Contents are stored
+  by their hash, so unchanged content is decoded only once, even if the file was touched or
+  copied. Both the path entries and the contents are evicted least recently used first.
+
+  The cache keeps the decoded text, as that is what aider works with. Large files are hashed
+  and decoded straight from a memory map, so only the text is kept, not also a copy of the
+  raw bytes.
+  """
+
+  def __init__(self, metrics=None, max_size=256 * 1024 * 1024, max_entries=16384, mmap_threshold=1024 * 1024, recent_change_window=2.0):
+    self.metrics = metrics
+    self.max_size = max_size
+    self.max_entries = max_entries
+    self.mmap_threshold = mmap_threshold
+    # files modified within this window are always verified by hash (mtime resolution can be coarse)
+    self.recent_change_window = recent_change_window
+    self.lock = threading.Lock()
+    # (path, encoding) -> (stat key, content hash)
+    self.entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+    # (content hash, encoding) -> text
+    self.contents: "OrderedDict[tuple, str]" = OrderedDict()
+    self.size = 0
+
+  def _count(self, name):
+    if self.metrics:
+      self.metrics.increment(name)
+
+  def _get_content(self, content_key):
+    with self.lock:
+      text = self.contents.get(content_key)
+      if text is not None:
+        self.contents.move_to_end(content_key)
+      return text
+
+  def _put(self, entry_key, stat_key, content_key, text):
+    with self.lock:
+      self.entries[entry_key] = (stat_key, content_key[0])
+      self.entries.move_to_end(entry_key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+      if content_key not in self.contents:
+        self.contents[content_key] = text
+        self.size += len(text)
+      while self.size > self.max_size and len(self.contents) > 1:
+        _, evicted = self.contents.popitem(last=False)
+        self.size -= len(evicted)
+
+  def read_text(self, filename, encoding="utf-8"):
+    """Reads the file like open(filename, "r", encoding=encoding).read() would, using the cache."""
+    path = os.path.abspath(str(filename))
+    file_stat = os.stat(path)
+    if stat.S_ISDIR(file_stat.st_mode):
+      raise IsADirectoryError(path)
+
+    entry_key = (path, encoding)
+    stat_key = (file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino)
+    recently_changed = time.time() - file_stat.st_mtime < self.recent_change_window
+
+    with self.lock:
+      entry = self.entries.get(entry_key)
+      if entry is not None:
+        self.entries.move_to_end(entry_key)
+    if entry and entry[0] == stat_key and not recently_changed:
+      text = self._get_content((entry[1], encoding))
+      if text is not None:
+        self._count("file_cache_hits")
+        return text
+
+    with open(path, "rb") as f:
+      if file_stat.st_size >= self.mmap_threshold:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+          digest = hashlib.blake2b(mapped, digest_size=20).hexdigest()
+          text = self._get_content((digest, encoding))
+          if text is None:
+            with memoryview(mapped) as view:
+              text = self._decode(view, encoding)
+      else:
+        data = f.read()
+        digest = hashlib.blake2b(data, digest_size=20).hexdigest()
+        text = self._get_content((digest, encoding))
+        if text is None:
+          text = self._decode(data, encoding)
+
+    self._count("file_cache_misses")
+    self._put(entry_key, stat_key, (digest, encoding), text)
+    return text
+
+  def _decode(self, data, encoding):
+    text = str(data, encoding)
+    # universal newlines, same as reading in text mode
+    if "\r" in text:
+      text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
 nest_asyncio.apply()
 
 confirmation_result = None
+# AiderDesk answers one question at a time, questions of concurrent prompts wait for their turn
+confirmation_lock = asyncio.Lock()
 
 def wait_for_async(connector, coroutine):
   try:
@@ -48,14 +361,1219 @@ def wait_for_async(connector, coroutine):
     sys.stderr.write(f"Error in wait_for_async: {str(e)}\n")
     return None
 
+def estimate_messages_memory(messages):
+  """Approximate memory held by chat messages, in bytes."""
+  size = 0
+  for msg in messages or []:
+    content = msg.get('content')
+    if isinstance(content, str):
+      size += len(content)
+    elif isinstance(content, list):
+      size += sum(len(part.get('text') or "") for part in content if isinstance(part, dict))
+  return size
+
+def estimate_coder_memory(coder):
+  """Approximate memory held by the heavy state of a coder, in bytes."""
+  size = estimate_messages_memory(coder.done_messages) + estimate_messages_memory(coder.cur_messages)
+  size += len(coder.partial_response_content or "")
+  size += len(getattr(coder, 'multi_response_content', None) or "")
+  size += sum(len(output) for output in getattr(coder, 'command_outputs', None) or [])
+  return size
+
+def release_coder_state(coder):
+  """Drops the heavy state of a coder that is no longer used for prompting."""
+  coder.done_messages = []
+  coder.cur_messages = []
+  coder.partial_response_content = ""
+  coder.partial_response_function_call = dict()
+  coder.multi_response_content = ""
+  coder.command_outputs = []
+
+class EventChannel:
+  """
+  Ordered, non-blocking channel for events sent from worker threads.
+
+  Worker threads enqueue events without waiting for them to be sent. The events are
+  drained and sent in batches on the connector's event loop. Actions sent directly by the
+  connector flush the channel first, so the overall order of events is kept.
+  """
+
+  def __init__(self, connector):
+    self.connector = connector
+    self.events = deque()
+    self.draining = False
+    self.idle = asyncio.Event()
+    self.idle.set()
+
+  def post_action(self, action):
+    self._post(("message", action))
+
+  def post_log_message(self, level, message, finished=False, prompt_context=None):
+    self._post(("log", build_log_payload(level, message, finished, prompt_context)))
+
+  def post_aggregated_log(self, payload):
+    """Posts a log message already handled by the log aggregator."""
+    self._post(("aggregated-log", payload))
+
+  def _post(self, event):
+    try:
+      self.connector.loop.call_soon_threadsafe(self._enqueue, event)
+    except RuntimeError:
+      # event loop is already closed
+      pass
+
+  def _enqueue(self, event):
+    self.events.append(event)
+    if not self.draining:
+      self.draining = True
+      self.idle.clear()
+      self.connector.loop.create_task(self._drain())
+
+  async def _drain(self):
+    try:
+      while self.events:
+        batch = list(self.events)
+        self.events.clear()
+        for event_name, payload in batch:
+          try:
+            if event_name == "log":
+              await self.connector.log_aggregator.send(payload)
+            elif event_name == "aggregated-log":
+              await self.connector.emit("log", payload)
+            else:
+              await self.connector.emit(event_name, payload)
+          except Exception as e:
+            sys.stderr.write(f"Error sending {event_name} event: {str(e)}\n")
+        await asyncio.sleep(0.01)
+    finally:
+      self.draining = False
+      self.idle.set()
+
+  def is_idle(self):
+    return not self.draining and not self.events
+
+  async def flush(self):
+    """Waits until all enqueued events are sent."""
+    while not self.is_idle():
+      await self.idle.wait()
+
+class LogAggregator:
+  """
+  Reduces the number of log messages sent to AiderDesk.
+
+  Identical messages within the repeat window are suppressed and reported once with the
+  repeat count when the window ends. Loading messages are held back for a short time, so
+  the ones finished right away are sent only once, as finished.
+  """
+
+  def __init__(self, connector, repeat_window=2.0, loading_delay=0.05):
+    self.connector = connector
+    self.repeat_window = repeat_window
+    self.loading_delay = loading_delay
+    # key -> [payload, suppressed count]
+    self.repeated: Dict[tuple, list] = {}
+    # key -> (payload, timer handle)
+    self.pending_loading: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+  @staticmethod
+  def _prompt_id(payload):
+    prompt_context = payload.get("promptContext")
+    return prompt_context.get("id") if prompt_context else None
+
+  async def send(self, payload):
+    if payload.get("level") == "loading":
+      await self._send_loading(payload)
+      return
+
+    # keep the order with loading messages held back
+    await self.flush_loading()
+
+    key = (payload.get("level"), payload.get("message"), payload.get("finished"), self._prompt_id(payload))
+    entry = self.repeated.get(key)
+    if entry:
+      entry[1] += 1
+      self.connector.metrics.increment("log_messages_suppressed")
+      return
+
+    self.repeated[key] = [payload, 0]
+    self.connector.loop.call_later(self.repeat_window, self._end_repeat_window, key)
+    await self.connector.emit("log", payload)
+
+  async def _send_loading(self, payload):
+    key = (payload.get("message"), self._prompt_id(payload))
+
+    if not payload.get("finished"):
+      pending = self.pending_loading.pop(key, None)
+      if pending:
+        pending[1].cancel()
+      timer = self.connector.loop.call_later(self.loading_delay, self._send_pending_loading, key)
+      self.pending_loading[key] = (payload, timer)
+      return
+
+    pending = self.pending_loading.pop(key, None)
+    if pending:
+      # started and finished right away, send only the finished message
+      pending[1].cancel()
+      self.connector.metrics.increment("log_loading_pairs_collapsed")
+
+    await self.flush_loading()
+    await self.connector.emit("log", payload)
+
+  async def flush_loading(self):
+    """Sends the held back loading messages right away."""
+    while self.pending_loading:
+      _, (payload, timer) = self.pending_loading.popitem(last=False)
+      timer.cancel()
+      await self.connector.emit("log", payload)
+
+  def _send_pending_loading(self, key):
+    pending = self.pending_loading.pop(key, None)
+    if pending:
+      # sent in order with the events posted before the timer fired
+      self.connector.event_channel.post_aggregated_log(pending[0])
+
+  async def flush(self):
+    """Sends the held back loading messages and the repeat counts right away."""
+    await self.flush_loading()
+    for key in list(self.repeated.keys()):
+      entry = self.repeated.pop(key)
+      if entry[1] > 0:
+        payload, count = entry
+        await self.connector.emit("log", dict(
+          payload,
+          message=f"{payload.get('message')} (repeated {count} more {'time' if count == 1 else 'times'})"
+        ))
+
+  def _end_repeat_window(self, key):
+    entry = self.repeated.pop(key, None)
+    if entry and entry[1] > 0:
+      payload, count = entry
+      self.connector.event_channel.post_aggregated_log(dict(
+        payload,
+        message=f"{payload.get('message')} (repeated {count} more {'time' if count == 1 else 'times'})"
+      ))
+
+class ReplayBuffer:
+  """
+  Keeps the last outbound events of each prompt, numbered by a sequence shared by all
+  events, so the events missed by AiderDesk while disconnected can be replayed. Events are
+  dropped once their delivery is confirmed.
+  """
+
+  # actions related to the connection itself, not replayed
+  SKIPPED_ACTIONS = {"init"}
+
+  def __init__(self, max_events_per_prompt=1000, max_prompts=32):
+    self.max_events_per_prompt = max_events_per_prompt
+    self.max_prompts = max_prompts
+    self.seq = 0
+    self.buffers: "OrderedDict[Optional[str], deque]" = OrderedDict()
+    # highest sequence number no longer available for replay
+    self.dropped_seq = 0
+
+  def add(self, key, event, data):
+    """Returns the data stamped with its sequence number."""
+    if not isinstance(data, dict) or data.get("action") in self.SKIPPED_ACTIONS:
+      return data
+
+    self.seq += 1
+    data = dict(data, seq=self.seq)
+    buffer = self.buffers.get(key)
+    if buffer is None:
+      buffer = self.buffers[key] = deque()
+      while len(self.buffers) > self.max_prompts:
+        _, evicted = self.buffers.popitem(last=False)
+        if evicted:
+          self.dropped_seq = max(self.dropped_seq, evicted[-1][2]["seq"])
+    else:
+      self.buffers.move_to_end(key)
+
+    buffer.append((event, data["seq"], data))
+    if len(buffer) > self.max_events_per_prompt:
+      self.dropped_seq = max(self.dropped_seq, buffer.popleft()[1])
+    return data
+
+  def acknowledge(self, seq):
+    """Drops the events up to seq, they no longer need to be replayed."""
+    for key in list(self.buffers.keys()):
+      buffer = self.buffers[key]
+      while buffer and buffer[0][1] <= seq:
+        self.dropped_seq = max(self.dropped_seq, buffer.popleft()[1])
+      if not buffer:
+        del self.buffers[key]
+
+  def get_events_after(self, seq):
+    """Returns the buffered (event, data) after seq and whether none of them is missing."""
+    events = sorted(
+      (item for buffer in self.buffers.values() for item in buffer if item[1] > seq),
+      key=lambda item: item[1]
+    )
+    return [(event, data) for event, _, data in events], self.dropped_seq <= seq
+
+class OutboundScheduler:
+  """
+  Per-prompt outbound queues drained onto the socket in weighted round-robin order.
+
+  Events keep their order within a prompt. Control actions (e.g. questions and prompt
+  finished) make their queue urgent, so it is drained before the others up to the control
+  action, without reordering it with the events enqueued before it.
+  """
+
+  CONTROL_ACTIONS = {"init", "ask-question", "prompt-finished", "history-resync"}
+
+  def __init__(self, connector, prompt_weight=1, global_weight=4, max_pending=64):
+    self.connector = connector
+    self.prompt_weight = prompt_weight
+    # events not related to any prompt (e.g. context info) are usually small and sparse
+    self.global_weight = global_weight
+    # producers not waiting for their events are throttled when their queue gets this long
+    self.max_pending = max_pending
+    self.queues: "OrderedDict[Optional[str], deque]" = OrderedDict()
+    self.urgent: Dict[Optional[str], int] = {}
+    self.wakeup = asyncio.Event()
+    self.task = None
+
+  @staticmethod
+  def get_queue_key(data):
+    if not isinstance(data, dict):
+      return None
+    prompt_context = data.get("promptContext")
+    if isinstance(prompt_context, dict) and prompt_context.get("id"):
+      return prompt_context["id"]
+    return data.get("promptId")
+
+  def _update_depth(self, key):
+    queue = self.queues.get(key)
+    self.connector.metrics.set_gauge(f"outbound_queue_depth.{key or 'global'}", len(queue) if queue else None)
+
+  async def send(self, event, data, wait=True):
+    key = self.get_queue_key(data)
+    if self.connector.replay_buffer is not None:
+      data = self.connector.replay_buffer.add(key, event, data)
+    is_control = isinstance(data, dict) and data.get("action") in self.CONTROL_ACTIONS
+    future = asyncio.get_running_loop().create_future()
+
+    queue = self.queues.get(key)
+    if queue is None:
+      queue = self.queues[key] = deque()
+    queue.append((event, data, future, is_control))
+    if is_control:
+      self.urgent[key] = self.urgent.get(key, 0) + 1
+    self._update_depth(key)
+
+    if self.task is None or self.task.done():
+      self.task = asyncio.get_running_loop().create_task(self._run())
+    self.wakeup.set()
+
+    if wait or len(queue) > self.max_pending:
+      await future
+    else:
+      future.add_done_callback(self._report_error)
+
+  async def flush(self):
+    """Waits until the events queued so far are sent."""
+    futures = [item[2] for queue in self.queues.values() for item in queue]
+    if futures:
+      await asyncio.gather(*futures, return_exceptions=True)
+
+  @staticmethod
+  def _report_error(future):
+    if not future.cancelled() and future.exception():
+      sys.stderr.write(f"Error sending event: {str(future.exception())}\n")
+
+  async def _emit_next(self, key):
+    queue = self.queues[key]
+    event, data, future, is_control = queue.popleft()
+    if is_control:
+      self.urgent[key] -= 1
+      if not self.urgent[key]:
+        del self.urgent[key]
+    if not queue:
+      del self.queues[key]
+    self._update_depth(key)
+
+    try:
+      await self.connector.transport_emit(event, data)
+      if not future.done():
+        future.set_result(None)
+    except Exception as e:
+      if not future.done():
+        future.set_exception(e)
+    return is_control
+
+  async def _run(self):
+    while True:
+      if not self.queues:
+        self.wakeup.clear()
+        await self.wakeup.wait()
+        continue
+
+      if self.urgent:
+        key = next(iter(self.urgent))
+        # drain the urgent queue up to its control action
+        while key in self.queues and not await self._emit_next(key):
+          pass
+        continue
+
+      for key in list(self.queues.keys()):
+        weight = self.global_weight if key is None else self.prompt_weight
+        for _ in range(weight):
+          if key not in self.queues:
+            break
+          await self._emit_next(key)
+        if self.urgent:
+          break
+        # move served queue to the end
+        if key in self.queues:
+          self.queues.move_to_end(key)
+
+class HistoryWriter:
+  """
+  Appends records of all IOs to a history file from a single background thread.
+
+  Records are written in batches, grouped by prompt so the records of concurrent prompts
+  do not interleave within a batch, and the file is fsynced periodically.
+  """
+
+  def __init__(self, path, encoding="utf-8", errors="strict", flush_interval=0.2, fsync_interval=1.0, max_batch_size=256):
+    self.path = Path(path)
+    self.encoding = encoding
+    self.errors = errors
+    self.flush_interval = flush_interval
+    self.fsync_interval = fsync_interval
+    self.max_batch_size = max_batch_size
+    self.records = queue.SimpleQueue()
+    self.failed = False
+    self.closed = False
+    self.file = None
+    self.last_fsync = time.monotonic()
+    self.thread = threading.Thread(target=self._run, name=f"history-writer-{self.path.name}", daemon=True)
+    self.thread.start()
+
+  def write(self, prompt_id, text):
+    if not self.failed and not self.closed:
+      self.records.put((prompt_id, text, None))
+
+  def flush(self, timeout=5):
+    """Waits until all records written so far are in the file."""
+    if self.closed or not self.thread.is_alive():
+      return
+    done = threading.Event()
+    self.records.put((None, None, done))
+    done.wait(timeout)
+
+  def close(self, timeout=5):
+    if self.closed:
+      return
+    self.flush(timeout)
+    self.closed = True
+    self.records.put(None)
+    self.thread.join(timeout)
+
+  def _run(self):
+    while True:
+      record = self.records.get()
+      if record is None:
+        break
+      batch = [record]
+      deadline = time.monotonic() + self.flush_interval
+      # collect the records coming shortly after, unless a flush was requested
+      while len(batch) < self.max_batch_size and batch[-1][2] is None:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+          break
+        try:
+          record = self.records.get(timeout=timeout)
+        except queue.Empty:
+          break
+        if record is None:
+          self.records.put(None)
+          break
+        batch.append(record)
+
+      self._write_batch(batch)
+
+    self._close_file()
+
+  def _write_batch(self, batch):
+    texts_by_prompt: "OrderedDict[Optional[str], List[str]]" = OrderedDict()
+    flush_events = []
+    for prompt_id, text, flush_event in batch:
+      if flush_event:
+        flush_events.append(flush_event)
+      else:
+        texts_by_prompt.setdefault(prompt_id, []).append(text)
+
+    if texts_by_prompt and not self.failed:
+      try:
+        if self.file is None:
+          self.path.parent.mkdir(parents=True, exist_ok=True)
+          self.file = self.path.open("a", encoding=self.encoding, errors=self.errors)
+        for texts in texts_by_prompt.values():
+          self.file.write("".join(texts))
+        self.file.flush()
+        if flush_events or time.monotonic() - self.last_fsync >= self.fsync_interval:
+          os.fsync(self.file.fileno())
+          self.last_fsync = time.monotonic()
+      except (PermissionError, OSError) as e:
+        # same as aider, disable further attempts to write
+        sys.stderr.write(f"Warning: Unable to write to history file {self.path}: {str(e)}\n")
+        self.failed = True
+        self._close_file()
+
+    for flush_event in flush_events:
+      flush_event.set()
+
+  def _close_file(self):
+    if self.file is not None:
+      try:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+      except (OSError, ValueError):
+        pass
+      self.file = None
+
+def build_log_payload(level, message, finished=False, prompt_context=None):
+  payload = {
+    "level": level,
+    "message": message,
+    "finished": finished
+  }
+
+  if prompt_context:
+    payload["promptContext"] = {
+      "id": prompt_context.id,
+      "group": prompt_context.group if hasattr(prompt_context, 'group') else None
+    }
+
+  return payload
+
+# RepoMap instances of the repo map worker process, keyed by their settings
+_worker_repo_maps: Dict[tuple, RepoMap] = {}
+
+def _get_worker_repo_map(settings):
+  key = tuple(sorted(settings.items()))
+  repo_map = _worker_repo_maps.get(key)
+  if repo_map is None:
+    io = InputOutput(pretty=False, fancy_input=False, yes=True)
+    repo_map = RepoMap(
+      settings["map_tokens"],
+      settings["root"],
+      models.Model(settings["model"]),
+      io,
+      settings["repo_content_prefix"],
+      False,
+      settings["max_context_window"],
+      map_mul_no_files=settings["map_mul_no_files"],
+      refresh=settings["refresh"],
+    )
+    _worker_repo_maps[key] = repo_map
+  return repo_map
+
+def _worker_get_repo_map(settings, chat_files, other_files):
+  return _get_worker_repo_map(settings).get_repo_map(chat_files, other_files)
+
+def _worker_parse_tags(settings, fnames):
+  repo_map = _get_worker_repo_map(settings)
+  for fname in fnames:
+    repo_map.get_tags(fname, repo_map.get_rel_fname(fname))
+  return len(fnames)
+
+class RepoMapWorker:
+  """
+  Builds repo maps in separate processes, so tree-sitter parsing and graph ranking do not
+  compete for the GIL with the threads streaming responses.
+
+  The map itself is built by a single long-lived process, so RepoMap's own caches stay warm.
+  Tags of new or changed file sets are parsed in parallel by a pool of processes first,
+  which fills the shared on-disk tags cache used by the map process.
+  """
+
+  def __init__(self, processes=None, min_files_per_process=50):
+    self.processes = processes or os.cpu_count() or 1
+    self.min_files_per_process = min_files_per_process
+    self.mp_context = multiprocessing.get_context("spawn")
+    self.map_pool = None
+    self.tags_pool = None
+    self.parsed_files_key = None
+
+  def get_map_pool(self):
+    if self.map_pool is None:
+      self.map_pool = ProcessPoolExecutor(max_workers=1, mp_context=self.mp_context)
+    return self.map_pool
+
+  def get_tags_pool(self):
+    if self.tags_pool is None:
+      self.tags_pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=self.mp_context)
+    return self.tags_pool
+
+  @staticmethod
+  def get_settings(repo_map, main_model):
+    return {
+      "map_tokens": repo_map.max_map_tokens,
+      "root": repo_map.root,
+      "model": main_model.name,
+      "repo_content_prefix": repo_map.repo_content_prefix,
+      "max_context_window": repo_map.max_context_window,
+      "map_mul_no_files": repo_map.map_mul_no_files,
+      "refresh": repo_map.refresh,
+    }
+
+  async def parse_tags(self, settings, fnames):
+    """Parses tags of the files in parallel across the worker processes."""
+    fnames = sorted(fnames)
+    files_key = (tuple(sorted(settings.items())), hashlib.sha256("\0".join(fnames).encode("utf-8", "surrogatepass")).hexdigest())
+    if files_key == self.parsed_files_key:
+      return
+
+    processes = min(self.processes, len(fnames) // self.min_files_per_process)
+    if processes > 1:
+      loop = asyncio.get_running_loop()
+      pool = self.get_tags_pool()
+      chunks = [fnames[i::processes] for i in range(processes)]
+      await asyncio.gather(*(loop.run_in_executor(pool, _worker_parse_tags, settings, chunk) for chunk in chunks))
+
+    self.parsed_files_key = files_key
+
+  async def get_repo_map(self, repo_map, main_model, chat_files, other_files):
+    settings = self.get_settings(repo_map, main_model)
+    await self.parse_tags(settings, set(chat_files) | set(other_files))
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self.get_map_pool(), _worker_get_repo_map, settings, set(chat_files), set(other_files))
+
+  def shutdown(self):
+    for pool in (self.map_pool, self.tags_pool):
+      if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+    self.map_pool = None
+    self.tags_pool = None
+
+def get_default_cache_dir():
+  """Returns the cache directory of the connector for the current user, accessible only by the user."""
+  if platform.system() == "Windows":
+    base_dir = os.getenv("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), "AppData", "Local")
+  elif platform.system() == "Darwin":
+    base_dir = os.path.join(os.path.expanduser("~"), "Library", "Caches")
+  else:
+    base_dir = os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+
+  cache_dir = os.path.join(base_dir, "aider-desk-connector")
+  os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+  # the mode of makedirs is not applied to an existing directory and is masked by umask
+  os.chmod(cache_dir, 0o700)
+  return cache_dir
+
+class ContextSnapshot:
+  """
+  Last context info actions (repo map, tokens info and autocompletion) sent to AiderDesk.
+
+  The snapshot is persisted per base directory as zlib compressed JSON and is only valid
+  for the git HEAD it was computed for. It is sent right after init, so the UI does not have
+  to wait for the context info to be computed, and it is used to skip sending actions that
+  did not change.
+  """
+
+  VERSION = 1
+
+  def __init__(self, base_dir, cache_dir):
+    self.path = os.path.join(cache_dir, hashlib.sha256(base_dir.encode("utf-8", "surrogatepass")).hexdigest()[:24] + ".snapshot")
+    self.lock = threading.Lock()
+    self.head = None
+    self.actions: Dict[str, dict] = {}
+
+  def load(self, head):
+    """Loads the persisted actions for the git HEAD."""
+    try:
+      with open(self.path, "rb") as f:
+        data = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+    except (OSError, ValueError, zlib.error):
+      data = None
+
+    with self.lock:
+      self.head = head
+      if data and data.get("version") == self.VERSION and data.get("head") == head:
+        self.actions = data.get("actions") or {}
+      else:
+        self.actions = {}
+      return dict(self.actions)
+
+  def get(self, kind):
+    with self.lock:
+      return self.actions.get(kind)
+
+  def update(self, kind, action, head) -> bool:
+    """Stores the action, returns False when it is the same as the stored one."""
+    with self.lock:
+      if self.head == head and self.actions.get(kind) == action:
+        return False
+      if self.head != head:
+        self.head = head
+        self.actions = {}
+      self.actions[kind] = action
+      return True
+
+  def save(self):
+    with self.lock:
+      data = {"version": self.VERSION, "head": self.head, "actions": dict(self.actions)}
+
+    try:
+      os.makedirs(os.path.dirname(self.path), exist_ok=True)
+      tmp_path = f"{self.path}.{os.getpid()}.tmp"
+      with open(tmp_path, "wb") as f:
+        f.write(zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8", "surrogatepass")))
+      os.replace(tmp_path, self.path)
+    except OSError as e:
+      sys.stderr.write(f"Unable to save context snapshot: {str(e)}\n")
+
+class FileTokenEstimator:
+  """
+  Token counts of large context files.
+
+  An estimate computed from evenly spaced samples of the file is available immediately,
+  together with its error bounds. The exact count is computed in the background by
+  streaming through the file in chunks, so the file is never loaded whole.
+  """
+
+  def __init__(self, large_file_size=512 * 1024, sample_count=8, sample_size=16 * 1024, chunk_size=1024 * 1024, max_exact_counts=1024):
+    self.large_file_size = large_file_size
+    self.sample_count = sample_count
+    self.sample_size = sample_size
+    self.chunk_size = chunk_size
+    self.max_exact_counts = max_exact_counts
+    self.lock = threading.Lock()
+    # (path, mtime, size, model name) -> exact token count, least recently used first
+    self.exact_counts: "OrderedDict[tuple, int]" = OrderedDict()
+
+  @staticmethod
+  def get_key(file_path, model):
+    file_stat = os.stat(file_path)
+    return file_path, file_stat.st_mtime_ns, file_stat.st_size, model.name
+
+  def is_large_file(self, file_path):
+    try:
+      return os.path.getsize(file_path) >= self.large_file_size
+    except OSError:
+      return False
+
+  def get_exact(self, key):
+    with self.lock:
+      tokens = self.exact_counts.get(key)
+      if tokens is not None:
+        self.exact_counts.move_to_end(key)
+      return tokens
+
+  def estimate(self, file_path, model, encoding="utf-8"):
+    """Returns estimated token count and its (low, high) bounds from samples of the file."""
+    size = os.path.getsize(file_path)
+    ratios = []
+    with open(file_path, "rb") as f:
+      for i in range(self.sample_count):
+        f.seek(max(0, (size - self.sample_size) * i // max(1, self.sample_count - 1)))
+        data = f.read(self.sample_size)
+        if not data:
+          continue
+        ratios.append(model.token_count(data.decode(encoding, errors="ignore")) / len(data))
+
+    if not ratios:
+      # fall back to usual ratio of 4 bytes per token
+      return size // 4, (size // 8, size // 2)
+
+    ratio = sum(ratios) / len(ratios)
+    return int(ratio * size), (int(min(ratios) * size), int(max(ratios) * size))
+
+  def count_exact(self, key, model, encoding="utf-8"):
+    """Counts tokens of the whole file, reading it in chunks split at line boundaries."""
+    exact = self.get_exact(key)
+    if exact is not None:
+      return exact
+
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    tokens = 0
+    remainder = ""
+    with open(key[0], "rb") as f:
+      while True:
+        data = f.read(self.chunk_size)
+        text = remainder + decoder.decode(data, final=not data)
+        if not data:
+          if text:
+            tokens += model.token_count(text)
+          break
+        split_at = text.rfind("\n") + 1
+        if split_at > 0:
+          tokens += model.token_count(text[:split_at])
+          remainder = text[split_at:]
+        else:
+          remainder = text
+
+    with self.lock:
+      self.exact_counts[key] = tokens
+      while len(self.exact_counts) > self.max_exact_counts:
+        self.exact_counts.popitem(last=False)
+    return tokens
+
+class TokenAccounting:
+  """
+  Memoizes token counts of chat messages by their content hash and of system prompts by
+  the settings they are built from, so refreshing the tokens info only counts new messages.
+
+  Message counts are additive: the count of a list of messages is the count of an empty
+  list plus the count each message adds to it.
+  """
+
+  def __init__(self, max_messages=10000, max_system_prompts=64):
+    self.max_messages = max_messages
+    self.max_system_prompts = max_system_prompts
+    self.message_tokens: "OrderedDict[tuple, int]" = OrderedDict()
+    self.empty_tokens: Dict[str, int] = {}
+    self.system_prompt_tokens: "OrderedDict[tuple, int]" = OrderedDict()
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def get_message_hash(message):
+    content = message.get("content")
+    if not isinstance(content, str):
+      content = json.dumps(content, sort_keys=True)
+    return hashlib.sha256(f"{message.get('role')}\0{content}".encode("utf-8", errors="surrogatepass")).hexdigest()
+
+  def _get_empty_tokens(self, model):
+    tokens = self.empty_tokens.get(model.name)
+    if tokens is None:
+      tokens = self.empty_tokens[model.name] = model.token_count([])
+    return tokens
+
+  def count_messages(self, model, messages):
+    if not messages:
+      return 0
+
+    empty_tokens = self._get_empty_tokens(model)
+    total = empty_tokens
+    for message in messages:
+      key = (model.name, self.get_message_hash(message))
+      with self.lock:
+        tokens = self.message_tokens.get(key)
+        if tokens is not None:
+          self.message_tokens.move_to_end(key)
+      if tokens is None:
+        tokens = model.token_count([dict(role=message["role"], content=message["content"])]) - empty_tokens
+        with self.lock:
+          self.message_tokens[key] = tokens
+          while len(self.message_tokens) > self.max_messages:
+            self.message_tokens.popitem(last=False)
+      total += tokens
+    return total
+
+  @staticmethod
+  def get_system_prompt_key(coder):
+    model = coder.main_model
+    return (
+      model.name,
+      coder.edit_format,
+      tuple(coder.fence),
+      coder.suggest_shell_commands,
+      model.lazy,
+      model.overeager,
+      coder.get_user_language(),
+      # the platform info in the prompt contains the current date
+      datetime.now().astimezone().strftime("%Y-%m-%d"),
+      coder.auto_lint,
+      repr(coder.lint_cmds),
+      coder.auto_test,
+      coder.test_cmd,
+    )
+
+  def count_system_prompt(self, coder):
+    key = self.get_system_prompt_key(coder)
+    with self.lock:
+      tokens = self.system_prompt_tokens.get(key)
+      if tokens is not None:
+        self.system_prompt_tokens.move_to_end(key)
+    if tokens is None:
+      main_sys = coder.fmt_system_prompt(coder.gpt_prompts.main_system)
+      main_sys += "\n" + coder.fmt_system_prompt(coder.gpt_prompts.system_reminder)
+      msgs = [
+        dict(role="system", content=main_sys),
+        dict(
+          role="system",
+          content=coder.fmt_system_prompt(coder.gpt_prompts.system_reminder),
+        ),
+      ]
+      tokens = coder.main_model.token_count(msgs)
+      with self.lock:
+        self.system_prompt_tokens[key] = tokens
+        while len(self.system_prompt_tokens) > self.max_system_prompts:
+          self.system_prompt_tokens.popitem(last=False)
+    return tokens
+
+class LLMResponseCache:
+  """
+  On-disk cache of LLM responses keyed by model, messages and request parameters, with
+  size based least-recently-used eviction. Only calls marked as cacheable in
+  llm_call_context and sent with temperature 0 are cached.
+  """
+
+  def __init__(self, directory, size_limit, metrics=None):
+    import diskcache
+
+    self.cache = diskcache.Cache(directory, size_limit=size_limit, eviction_policy="least-recently-used")
+    self.metrics = metrics
+
+  @staticmethod
+  def is_deterministic(model):
+    if isinstance(model.use_temperature, bool):
+      # aider sends temperature 0 unless the model does not support temperature
+      return model.use_temperature
+    return float(model.use_temperature) == 0
+
+  @staticmethod
+  def get_key(model, messages):
+    key = json.dumps({
+      "model": model.name,
+      "messages": messages,
+      "params": model.extra_params or {},
+      "temperature": model.use_temperature,
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(key.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+  def get_or_send(self, model, messages, send):
+    if not self.is_deterministic(model):
+      return send()
+
+    key = self.get_key(model, messages)
+    try:
+      response = self.cache.get(key)
+    except Exception:
+      response = None
+    if response is not None:
+      if self.metrics:
+        self.metrics.increment("llm_cache_hits")
+      return response
+
+    if self.metrics:
+      self.metrics.increment("llm_cache_misses")
+    response = send()
+    if response:
+      try:
+        self.cache.set(key, response)
+      except Exception:
+        # the cache is best effort
+        pass
+    return response
+
+  def close(self):
+    self.cache.close()
+
+llm_call_context = threading.local()
+
+original_simple_send_with_retries = models.Model.simple_send_with_retries
+
+def _patched_simple_send_with_retries(model, messages):
+  response_cache = getattr(llm_call_context, 'response_cache', None)
+  if response_cache is None:
+    return original_simple_send_with_retries(model, messages)
+  return response_cache.get_or_send(model, messages, lambda: original_simple_send_with_retries(model, messages))
+
+def patch_simple_send_with_retries():
+  # Model instances are copied by ModelCache, so the method is patched on the class
+  models.Model.simple_send_with_retries = _patched_simple_send_with_retries
+
+class ModelCache:
+  """
+  Cache of models.Model instances and their sanity check results.
+
+  Both are keyed by the model names and a hash of the environment variables, so they are
+  invalidated when the environment changes (e.g. API keys updated via update-env-vars).
+  """
+
+  def __init__(self, max_size=16):
+    self.max_size = max_size
+    self.lock = threading.Lock()
+    self.env_hash = None
+    self.models: "OrderedDict[tuple, models.Model]" = OrderedDict()
+    self.sanity_checks: Dict[tuple, bool] = {}
+
+  @staticmethod
+  def get_env_hash():
+    env = "\0".join(f"{key}={value}" for key, value in sorted(os.environ.items()))
+    return hashlib.sha256(env.encode("utf-8", "surrogatepass")).hexdigest()
+
+  def _check_env(self):
+    env_hash = self.get_env_hash()
+    if env_hash != self.env_hash:
+      self.env_hash = env_hash
+      self.models.clear()
+      self.sanity_checks.clear()
+    return env_hash
+
+  def get(self, name, weak_model=None, editor_model=None) -> models.Model:
+    """Returns a model instance, reusing a cached one with its own copy of mutable settings."""
+    key = (name, weak_model, editor_model)
+    with self.lock:
+      self._check_env()
+      model = self.models.get(key)
+      if model is not None:
+        self.models.move_to_end(key)
+
+    if model is None:
+      model = models.Model(name, weak_model=weak_model, editor_model=editor_model)
+      with self.lock:
+        self.models[key] = model
+        while len(self.models) > self.max_size:
+          self.models.popitem(last=False)
+
+    # reasoning effort and thinking tokens are set on the instance
+    model_copy = copy.copy(model)
+    model_copy.extra_params = copy.deepcopy(model.extra_params)
+    return model_copy
+
+  def sanity_check_models(self, io, main_model):
+    """Runs models.sanity_check_models, unless the models already passed with the same environment."""
+    weak_model = main_model.weak_model.name if main_model.weak_model else None
+    editor_model = main_model.editor_model.name if main_model.editor_model else None
+    with self.lock:
+      key = (main_model.name, weak_model, editor_model, self._check_env())
+      if self.sanity_checks.get(key) is False:
+        return False
+
+    # problems are checked again, so the warnings are shown every time
+    problem = models.sanity_check_models(io, main_model)
+    with self.lock:
+      self.sanity_checks[key] = bool(problem)
+    return problem
+
+class HistorySummarizer:
+  """
+  Summarizes older chat history with the weak model while no prompt is running, so long
+  sessions do not send their whole history with every prompt.
+
+  Summaries are cached by the chained hash of the messages they summarize (the same chain
+  as SessionHistory) and applied to any history starting with those messages once the
+  history exceeds max_tokens. A history is summarized starting from the summary of its
+  longest summarized prefix. Histories are summarized down to half of max_tokens, so the
+  summary is ready before the history reaches max_tokens.
+  """
+
+  def __init__(self, connector, max_tokens, idle_delay=5.0, max_summaries=16):
+    self.connector = connector
+    self.max_tokens = max_tokens
+    self.target_tokens = max(int(max_tokens * 0.5), 1)
+    self.idle_delay = idle_delay
+    self.max_summaries = max_summaries
+    self.summaries: "OrderedDict[str, List[Dict[str, str]]]" = OrderedDict()
+    self.pending = None
+    self.task = None
+
+  @staticmethod
+  def get_prefix_hashes(messages):
+    history = SessionHistory()
+    history.append(messages)
+    return history.hashes
+
+  def count_tokens(self, messages):
+    return self.connector.token_accounting.count_messages(self.connector.coder.main_model, messages)
+
+  def get_summarized(self, messages):
+    """Returns the messages with their longest summarized prefix replaced by its summary."""
+    hashes = self.get_prefix_hashes(messages)
+    for length in range(len(messages), 1, -1):
+      summary = self.summaries.get(hashes[length])
+      if summary is not None:
+        self.summaries.move_to_end(hashes[length])
+        return summary + messages[length:]
+    return messages
+
+  def apply(self, messages):
+    if len(messages) < 2 or self.count_tokens(messages) <= self.max_tokens:
+      return messages
+
+    summarized = self.get_summarized(messages)
+    if summarized is not messages:
+      self.connector.metrics.increment("history_summaries_applied")
+    return summarized
+
+  def schedule(self, messages):
+    """Summarizes the messages when idle, once they get close to max_tokens."""
+    if len(messages) < 2 or self.count_tokens(messages) <= self.max_tokens * 0.75:
+      return
+    if self.get_prefix_hashes(messages)[-1] in self.summaries:
+      return
+
+    self.pending = list(messages)
+    if self.task is None or self.task.done():
+      self.task = self.connector.loop.create_task(self._run())
+
+  async def _run(self):
+    while self.pending is not None:
+      await asyncio.sleep(self.idle_delay)
+      if self.connector.prompt_executor.active_prompts:
+        continue
+
+      messages = self.pending
+      self.pending = None
+      try:
+        summary = await asyncio.to_thread(self.summarize, self.get_summarized(messages))
+      except Exception as e:
+        self.connector.coder.io.tool_warning(f"Unable to summarize chat history: {str(e)}")
+        continue
+
+      if summary:
+        self.summaries[self.get_prefix_hashes(messages)[-1]] = summary
+        while len(self.summaries) > self.max_summaries:
+          self.summaries.popitem(last=False)
+        self.connector.metrics.increment("history_summaries")
+
+  def summarize(self, messages):
+    main_model = self.connector.coder.main_model
+    summarizer = ChatSummary([main_model.weak_model, main_model], self.target_tokens)
+    if not summarizer.too_big(messages):
+      return None
+
+    # the summary of the same messages can be reused
+    llm_call_context.response_cache = self.connector.llm_response_cache
+    try:
+      return summarizer.summarize(messages)
+    finally:
+      llm_call_context.response_cache = None
+
+class HttpClientPool:
+  """
+  Process-wide keep-alive HTTP connection pool installed as litellm's client session, so the
+  model calls of all coders reuse the connections to the providers instead of opening new
+  ones for every prompt.
+  """
+
+  # providers whose litellm handlers send the requests with litellm.client_session, the others
+  # (e.g. Anthropic) use their own HTTP clients and would not reuse the warmed up connections
+  POOLED_PROVIDERS = {"openai", "azure", "text-completion-openai"}
+
+  # environment variables litellm reads the API base of the pooled providers from
+  API_BASE_ENV_VARS = {
+    "openai": ("OPENAI_BASE_URL", "OPENAI_API_BASE"),
+    "text-completion-openai": ("OPENAI_BASE_URL", "OPENAI_API_BASE"),
+    "azure": ("AZURE_API_BASE",),
+  }
+
+  # providers litellm does not report an API base for
+  DEFAULT_API_BASES = {
+    "openai": "https://api.openai.com",
+    "text-completion-openai": "https://api.openai.com",
+  }
+
+  def __init__(self, metrics, keepalive_expiry=120.0, max_connections=20, http2=True):
+    if http2:
+      try:
+        import h2 # noqa: F401
+      except ImportError:
+        # HTTP/2 support is optional in httpx
+        http2 = False
+    self.http2 = http2
+    self.metrics = metrics
+    self.last_connections = 0
+    # no explicit transport, so httpx keeps mounting the proxies from the environment
+    self.client = httpx.Client(
+      http2=http2,
+      limits=httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+        keepalive_expiry=keepalive_expiry,
+      ),
+      timeout=httpx.Timeout(litellm.request_timeout, connect=5.0),
+      event_hooks={"response": [self.record_response]},
+    )
+
+  @classmethod
+  def install(cls, metrics, **kwargs):
+    """Creates the pool and sets it as litellm's client session, unless aider already set its own."""
+    if litellm.client_session is not None:
+      # e.g. aider's client without SSL verification
+      return None
+    pool = cls(metrics, **kwargs)
+    litellm.client_session = pool.client
+    return pool
+
+  @classmethod
+  def get_base_url(cls, model_name):
+    """Returns the base URL of the model's provider, None when its requests do not go through the pool."""
+    try:
+      _, provider, _, provider_api_base = litellm.get_llm_provider(model_name)
+    except Exception:
+      return None
+    if provider not in cls.POOLED_PROVIDERS:
+      return None
+
+    api_base = provider_api_base or litellm.api_base
+    for env_var in cls.API_BASE_ENV_VARS.get(provider, ()):
+      api_base = api_base or os.getenv(env_var)
+    if not api_base:
+      try:
+        api_base = litellm.get_api_base(model_name, {})
+      except Exception:
+        api_base = None
+    api_base = api_base or cls.DEFAULT_API_BASES.get(provider)
+    if not api_base:
+      return None
+
+    url = urlparse(api_base)
+    return f"{url.scheme}://{url.netloc}" if url.scheme and url.netloc else None
+
+  def warm_up(self, model_names):
+    """Opens the connections to the providers of the models, so the first prompt does not wait for them."""
+    base_urls = {self.get_base_url(model_name) for model_name in model_names if model_name}
+    for base_url in sorted(url for url in base_urls if url):
+      try:
+        self.client.head(base_url, timeout=5.0)
+      except httpx.HTTPError:
+        pass
+
+  def get_connections(self):
+    transports = [self.client._transport, *self.client._mounts.values()]
+    connections = []
+    for transport in transports:
+      pool = getattr(transport, "_pool", None)
+      connections.extend(getattr(pool, "connections", None) or [])
+    return connections
+
+  def record_response(self, response):
+    self.metrics.increment("http_requests")
+    http_version = response.extensions.get("http_version", b"").decode("ascii", errors="replace")
+    if http_version:
+      self.metrics.increment(f"http_responses.{http_version}")
+    connections = len(self.get_connections())
+    if connections > self.last_connections:
+      self.metrics.increment("http_connections_opened", connections - self.last_connections)
+    self.last_connections = connections
+    self.metrics.set_gauge("http_pool_connections", connections)
+
+  def get_stats(self):
+    connections = self.get_connections()
+    return {
+      "http2": self.http2,
+      "connections": len(connections),
+      "idleConnections": sum(1 for connection in connections if connection.is_idle()),
+      "connectionsInfo": [connection.info() for connection in connections],
+    }
+
 class PromptExecutor:
   """Manages prompt execution as concurrent asyncio tasks."""
 
-  def __init__(self, connector):
+  def __init__(self, connector, memory_budget=None, memory_budget_timeout=300):
     self.connector = connector
+    # maximum estimated memory (in bytes) of all active prompts, None means unlimited
+    self.memory_budget = memory_budget
+    self.memory_budget_timeout = memory_budget_timeout
+    self.memory_usage: Dict[str, int] = {}
+    self.memory_released = asyncio.Condition()
     self.active_prompts: Dict[str, asyncio.Task] = {}
     self.active_coders: Dict[str, Coder] = {}
     self.active_futures: Dict[str, Future] = {}
+    # editor coders prepared while architect response is streaming, keyed by architect prompt ID
+    self.speculative_editors: Dict[str, Future] = {}
+    # prompt ID -> (metric name, start time) for measuring time to the first token
+    self.first_token_timers: Dict[str, tuple] = {}
+    self.active_batches: Dict[str, asyncio.Task] = {}
+    # results of the prompts run as batch tasks, filled when the prompts finish
+    self.batch_results: Dict[str, dict] = {}
     self.executor = None
 
   def get_executor(self):
@@ -65,6 +1583,14 @@ class PromptExecutor:
     return self.executor
 
   async def run_prompt(self, prompt: str, prompt_context: PromptContext, mode=None, architect_model=None, messages=None, files=None, coder=None):
+    if coder is None and not await self.wait_for_memory_budget(prompt_context, len(prompt) + estimate_messages_memory(messages)):
+      await self.connector.send_log_message("error", "Prompt was refused, memory budget of the connector has been exceeded.", False, prompt_context)
+      await self.connector.send_action({
+        "action": "prompt-finished",
+        "promptId": prompt_context.id
+      })
+      return prompt_context.id
+
     prompt_coro = self._run_prompt_task(prompt, prompt_context, mode, architect_model, messages, files, coder)
 
     # Submit the coroutine to the executor, which turns it into a background Task.
@@ -126,6 +1652,11 @@ class PromptExecutor:
         break
       whole_content += chunk
 
+      first_token_timer = self.first_token_timers.pop(prompt_context.id, None)
+      if first_token_timer:
+        metric_name, start_time = first_token_timer
+        self.connector.metrics.record_timing(metric_name, (time.monotonic() - start_time) * 1000)
+
       response_payload = {
         "id": response_id,
         "action": "response",
@@ -149,7 +1680,7 @@ class PromptExecutor:
       running_model = self.connector.coder.main_model
 
       if mode == "architect" and architect_model:
-        running_model = models.Model(architect_model, weak_model=coder_model.weak_model.name, editor_model=coder_model.name)
+        running_model = self.connector.model_cache.get(architect_model, weak_model=coder_model.weak_model.name, editor_model=coder_model.name)
         sequence_number = -1
 
       coder = clone_coder(
@@ -166,6 +1697,7 @@ class PromptExecutor:
     coder.io.add_command_to_context = False
 
     self.active_coders[prompt_context.id] = coder
+    self.update_memory_usage(prompt_context.id, coder)
 
     # we need to disable auto accept as this does not work properly with AiderDesk
     coder.auto_accept_architect=False
@@ -173,7 +1705,12 @@ class PromptExecutor:
     # setting usage report to None to avoid no attribute error
     coder.usage_report = None
 
+    if mode == "architect" and not coder_provided:
+      # prepare the editor coder while the architect response is streaming
+      self.prepare_editor_coder(coder, prompt_context)
+
     whole_content, response_id = await self._stream_and_send_responses(coder, prompt_context, prompt, prompt_context.id)
+    self.update_memory_usage(prompt_context.id, coder)
 
     if not whole_content and not self.is_prompt_interrupted(prompt_context.id):
       # if there was no content, use the partial_response_content value (case for non streaming models)
@@ -232,6 +1769,7 @@ class PromptExecutor:
           f"reflection in {prompt_context.id}",
           {"reflectedMessage": reflection_prompt}
         )
+        self.update_memory_usage(prompt_context.id, coder)
 
         sequence_number += 1
         response_data = {
@@ -256,6 +1794,15 @@ class PromptExecutor:
       self.connector.coder.total_cost = coder.total_cost
       self.connector.coder.aider_commit_hashes = coder.aider_commit_hashes
 
+    batch_result = self.batch_results.get(prompt_context.id)
+    if batch_result is not None:
+      batch_result.update({
+        "status": "completed",
+        "editedFiles": sorted(coder.aider_edited_files),
+        "commitHash": coder.last_aider_commit_hash,
+        "commitMessage": coder.last_aider_commit_message,
+      })
+
     # Send prompt-finished message
     await self.connector.send_action({
       "action": "prompt-finished",
@@ -264,9 +1811,11 @@ class PromptExecutor:
 
     # Send command outputs as context messages
     if hasattr(coder, 'command_outputs') and coder.command_outputs:
+      context_messages = []
       for output in coder.command_outputs:
-        await self.connector.send_add_context_message("user", output)
-        await self.connector.send_add_context_message("assistant", "Ok.")
+        context_messages.append({"role": "user", "content": output})
+        context_messages.append({"role": "assistant", "content": "Ok."})
+      await self.connector.send_add_context_messages(context_messages)
 
   async def _execute_prompt_wrapper(self, prompt_context: PromptContext, prompt_coro: Coroutine[Any, Any, Any]):
     """
@@ -288,12 +1837,106 @@ class PromptExecutor:
     finally:
       # Always clean up the task from the active prompts dict.
       self._cleanup_prompt(prompt_id)
+      await self.notify_memory_released()
 
   def _cleanup_prompt(self, prompt_id: str):
     """Clean up completed or cancelled prompt."""
     self.active_prompts.pop(prompt_id, None)
-    self.active_coders.pop(prompt_id, None)
-    self.active_futures.pop(prompt_id, None)
+    coder = self.active_coders.pop(prompt_id, None)
+    future = self.active_futures.pop(prompt_id, None)
+    self.first_token_timers.pop(prompt_id, None)
+
+    # the clone is not used anymore, do not wait for the garbage collector to free its state
+    if coder is not None and coder is not self.connector.coder:
+      if future is not None and not future.done():
+        # worker thread of a cancelled prompt can still be using the coder
+        future.add_done_callback(lambda _: release_coder_state(coder))
+      else:
+        release_coder_state(coder)
+    self.update_memory_usage(prompt_id, None)
+
+    # editor coder was not used (edits were not confirmed)
+    speculative_editor = self.speculative_editors.pop(prompt_id, None)
+    if speculative_editor:
+      speculative_editor.cancel()
+
+  def prepare_editor_coder(self, architect_coder, prompt_context: PromptContext):
+    """Speculatively clones the editor coder for an architect prompt in the background."""
+    def _prepare():
+      start_time = time.monotonic()
+      editor_prompt_context = PromptContext(str(uuid.uuid4()), prompt_context.group)
+      editor_coder = create_editor_coder(self.connector, architect_coder, editor_prompt_context)
+      # load the files and pick the fence, so it does not need to be done after confirmation
+      editor_coder.choose_fence()
+      self.connector.metrics.record_timing("editor_coder_prepare", (time.monotonic() - start_time) * 1000)
+      return editor_coder, editor_prompt_context
+
+    self.speculative_editors[prompt_context.id] = self.get_executor().submit(_prepare)
+
+  async def take_speculative_editor(self, prompt_id: str, architect_coder):
+    """Returns the speculatively prepared editor coder and its prompt context if it is ready and still valid."""
+    future = self.speculative_editors.pop(prompt_id, None)
+    if future is None or future.cancelled():
+      return None
+
+    try:
+      editor_coder, editor_prompt_context = await asyncio.wrap_future(future)
+    except Exception as e:
+      self.connector.coder.io.tool_warning(f"Failed to prepare editor coder: {str(e)}")
+      return None
+
+    editor_model = architect_coder.main_model.editor_model or architect_coder.main_model
+    if editor_coder.main_model is not editor_model or editor_coder.edit_format != self.connector.coder.edit_format:
+      # models or edit format changed in the meantime
+      return None
+
+    # architect could have added files while streaming
+    editor_coder.abs_fnames = set(architect_coder.abs_fnames)
+    editor_coder.abs_read_only_fnames = set(architect_coder.abs_read_only_fnames)
+    editor_coder.total_cost = architect_coder.total_cost
+    return editor_coder, editor_prompt_context
+
+  def update_memory_usage(self, prompt_id: str, coder=None):
+    """Updates the memory accounting of the prompt, removes it when coder is None."""
+    if coder is None:
+      self.memory_usage.pop(prompt_id, None)
+    else:
+      self.memory_usage[prompt_id] = estimate_coder_memory(coder)
+
+    metrics = self.connector.metrics
+    metrics.set_gauge(f"prompt_memory_bytes.{prompt_id}", self.memory_usage.get(prompt_id))
+    metrics.set_gauge("prompts_memory_bytes", sum(self.memory_usage.values()))
+    metrics.set_gauge("active_prompts", len(self.active_prompts))
+
+  def is_over_memory_budget(self, additional_memory=0):
+    if not self.memory_budget or not self.active_prompts:
+      # always allow at least one prompt to run
+      return False
+    return sum(self.memory_usage.values()) + additional_memory > self.memory_budget
+
+  async def wait_for_memory_budget(self, prompt_context: PromptContext, additional_memory=0) -> bool:
+    """Waits until the prompt fits into the memory budget. Returns False when it did not fit in time."""
+    if not self.is_over_memory_budget(additional_memory):
+      return True
+
+    self.connector.metrics.increment("prompts_queued_by_memory_budget")
+    await self.connector.send_log_message("loading", "Waiting for other prompts to finish...", False, prompt_context)
+    try:
+      async with self.memory_released:
+        await asyncio.wait_for(
+          self.memory_released.wait_for(lambda: not self.is_over_memory_budget(additional_memory)),
+          self.memory_budget_timeout
+        )
+      return True
+    except asyncio.TimeoutError:
+      self.connector.metrics.increment("prompts_refused_by_memory_budget")
+      return False
+    finally:
+      await self.connector.send_log_message("loading", "Waiting for other prompts to finish...", True, prompt_context)
+
+  async def notify_memory_released(self):
+    async with self.memory_released:
+      self.memory_released.notify_all()
 
   def get_coder(self, prompt_id: str) -> Optional[Coder]:
     """Retrieve the coder instance for a given prompt ID."""
@@ -330,8 +1973,109 @@ class PromptExecutor:
       return True
     return False
 
+  async def run_prompt_batch(self, batch_id, tasks, mode=None, architect_model=None, messages=None, files=None, concurrency=4, group=None):
+    """
+    Runs the prompts of the tasks, each with its own files added to the shared files, with
+    at most `concurrency` of them at the same time. The progress is reported with
+    prompt-batch-progress actions and the results with a prompt-batch-finished action.
+
+    Shared files are read-only in the tasks. Tasks editing the same file do not run at the
+    same time. Commits of the tasks are serialized by the git lock of the connector.
+    """
+    if batch_id in self.active_batches:
+      await self.connector.send_log_message("error", f"Prompt batch {batch_id} is already running.")
+      return
+    if any((task.get("mode") or mode) == "architect" for task in tasks):
+      # the confirmation of the editor answers only one question at a time
+      await self.connector.send_log_message("error", f"Prompt batch {batch_id} was refused, architect mode is not supported in prompt batches.")
+      return
+
+    task = self.connector.loop.create_task(self._run_prompt_batch(batch_id, tasks, mode, architect_model, messages, files, concurrency, group))
+    self.active_batches[batch_id] = task
+    task.add_done_callback(lambda _: self.active_batches.pop(batch_id, None))
+
+  async def _run_prompt_batch(self, batch_id, tasks, mode, architect_model, messages, files, concurrency, group):
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    file_locks: Dict[str, asyncio.Lock] = {}
+    results = [
+      {"id": task.get("id") or f"{batch_id}-{index}", "prompt": task["prompt"], "status": "pending"}
+      for index, task in enumerate(tasks)
+    ]
+    group = group or {"id": batch_id, "name": f"Batch of {len(tasks)} prompts"}
+
+    async def send_progress(result=None):
+      await self.connector.send_action({
+        "action": "prompt-batch-progress",
+        "batchId": batch_id,
+        "total": len(results),
+        "running": sum(1 for r in results if r["status"] == "running"),
+        "completed": sum(1 for r in results if r["status"] == "completed"),
+        "failed": sum(1 for r in results if r["status"] in ("failed", "cancelled", "refused")),
+        "task": result,
+      }, False)
+
+    def get_abs_path(file):
+      # the same file can be given as relative, ./relative or absolute path
+      return self.connector.coder.abs_root_path(file["path"])
+
+    async def run_task(task, result):
+      own_files = list(task.get("files") or [])
+      own_paths = {get_abs_path(file) for file in own_files}
+      # the shared files can be used by all tasks at the same time, so they are not edited
+      task_files = [{**file, "readOnly": True} for file in files or [] if get_abs_path(file) not in own_paths] + own_files
+      editable_paths = sorted({get_abs_path(file) for file in own_files if not file.get("readOnly", False)})
+      prompt_context = PromptContext(result["id"], group)
+
+      async with contextlib.AsyncExitStack() as stack:
+        # locks are taken in the same order by all tasks
+        for path in editable_paths:
+          await stack.enter_async_context(file_locks.setdefault(path, asyncio.Lock()))
+        await stack.enter_async_context(semaphore)
+
+        result["status"] = "running"
+        await send_progress(result)
+        self.batch_results[prompt_context.id] = result
+        try:
+          await self.run_prompt(task["prompt"], prompt_context, task.get("mode") or mode, architect_model, messages, task_files)
+          prompt_task = self.active_prompts.get(prompt_context.id)
+          if prompt_task is None:
+            result["status"] = "refused"
+          else:
+            await prompt_task
+            if result["status"] == "running":
+              # the prompt task handles its own cancellation
+              result["status"] = "cancelled"
+        except asyncio.CancelledError:
+          result["status"] = "cancelled"
+          await self.cancel_prompt(prompt_context.id)
+          raise
+        except Exception as e:
+          result["status"] = "failed"
+          result["error"] = str(e)
+        finally:
+          self.batch_results.pop(prompt_context.id, None)
+
+      await send_progress(result)
+
+    await send_progress()
+    try:
+      await asyncio.gather(*(run_task(task, result) for task, result in zip(tasks, results)))
+    except asyncio.CancelledError:
+      for result in results:
+        if result["status"] in ("pending", "running"):
+          result["status"] = "cancelled"
+    finally:
+      await self.connector.send_action({
+        "action": "prompt-batch-finished",
+        "batchId": batch_id,
+        "results": results,
+      })
+
   async def interrupt_all_prompts(self):
     """Interrupt all active prompts."""
+    # batches would start their remaining prompts
+    for batch_task in list(self.active_batches.values()):
+      batch_task.cancel()
     # Create a copy of keys to avoid issues with modifying the dict while iterating
     prompt_ids = list(self.active_prompts.keys())
     if prompt_ids:
@@ -349,13 +2093,11 @@ class PromptExecutor:
     """Shutdown the executor by cancelling all active tasks."""
     await self.interrupt_all_prompts()
 
-async def run_editor_coder_stream(architect_coder, connector, prompt_context):
+def create_editor_coder(connector, architect_coder, editor_prompt_context):
   # Use the editor_model from the main_model if it exists, otherwise use the main_model itself
   editor_model = architect_coder.main_model.editor_model or architect_coder.main_model
-  # Generate a prompt info for the editor coder
-  editor_prompt_context = PromptContext(str(uuid.uuid4()), prompt_context.group)
 
-  editor_coder = clone_coder(
+  return clone_coder(
     connector,
     architect_coder,
     editor_prompt_context,
@@ -366,9 +2108,26 @@ async def run_editor_coder_stream(architect_coder, connector, prompt_context):
     total_cost=architect_coder.total_cost,
     cache_prompts=False,
     num_cache_warming_pings=0,
+    done_messages=[],
+    cur_messages=[],
   )
-  editor_coder.cur_messages = []
-  editor_coder.done_messages = []
+
+async def run_editor_coder_stream(architect_coder, connector, prompt_context):
+  start_time = time.monotonic()
+  speculative_editor = await connector.prompt_executor.take_speculative_editor(prompt_context.id, architect_coder)
+
+  if speculative_editor:
+    editor_coder, editor_prompt_context = speculative_editor
+    connector.metrics.increment("editor_coder_speculation_hits")
+    first_token_metric = "editor_first_token_speculative"
+  else:
+    # Generate a prompt info for the editor coder
+    editor_prompt_context = PromptContext(str(uuid.uuid4()), prompt_context.group)
+    editor_coder = create_editor_coder(connector, architect_coder, editor_prompt_context)
+    connector.metrics.increment("editor_coder_speculation_misses")
+    first_token_metric = "editor_first_token_cold"
+
+  connector.prompt_executor.first_token_timers[editor_prompt_context.id] = (first_token_metric, start_time)
 
   # Start the prompt execution (non-blocking)
 
@@ -408,18 +2167,56 @@ class ConnectorInputOutput(InputOutput):
       for message in messages:
         # Extract current command from "Running" messages
         if message.startswith("Running ") and not self.current_command:
-          async def send_use_command_output():
-            await self.connector.send_action({
-              "action": "use-command-output",
-              "command": self.current_command,
-            })
-
           self.current_command = message[8:]
-          wait_for_async(self.connector, send_use_command_output())
+          self.connector.event_channel.post_action({
+            "action": "use-command-output",
+            "command": self.current_command,
+          })
     else:
       for message in messages:
         if message.startswith("Commit "):
-          wait_for_async(self.connector, self.connector.send_log_message("info", message, True, self.prompt_context))
+          self.connector.event_channel.post_log_message("info", message, True, self.prompt_context)
+
+  def read_text(self, filename, silent=False):
+    if not self.connector or is_image_file(filename):
+      return super().read_text(filename, silent)
+
+    try:
+      return self.connector.file_cache.read_text(filename, self.encoding)
+    except (OSError, UnicodeError, ValueError):
+      # let aider handle and report the error
+      return super().read_text(filename, silent)
+
+  def get_history_writer(self, path, encoding, errors):
+    if not path or not getattr(self, 'connector', None):
+      return None
+    writer = self.connector.get_history_writer(path, encoding, errors)
+    return None if writer.failed else writer
+
+  def append_chat_history(self, text, linebreak=False, blockquote=False, strip=True):
+    writer = self.get_history_writer(self.chat_history_file, self.encoding, "ignore")
+    if not writer:
+      return super().append_chat_history(text, linebreak=linebreak, blockquote=blockquote, strip=strip)
+
+    if blockquote:
+      if strip:
+        text = text.strip()
+      text = "> " + text
+    if linebreak:
+      if strip:
+        text = text.rstrip()
+      text = text + "  \n"
+    if not text.endswith("\n"):
+      text += "\n"
+    writer.write(self.prompt_context.id if self.prompt_context else None, text)
+
+  def log_llm_history(self, role, content):
+    writer = self.get_history_writer(self.llm_history_file, "utf-8", "strict")
+    if not writer:
+      return super().log_llm_history(role, content)
+
+    timestamp = datetime.now().isoformat(timespec="seconds")
+    writer.write(self.prompt_context.id if self.prompt_context else None, f"{role.upper()} {timestamp}\n{content}\n")
 
   def is_warning_ignored(self, message):
     if message == "Warning: it's best to only add files that need changes to the chat.":
@@ -433,7 +2230,7 @@ class ConnectorInputOutput(InputOutput):
       return
     super().tool_warning(message, strip)
     if self.connector and not self.is_warning_ignored(message):
-      wait_for_async(self.connector, self.connector.send_log_message("warning", message, self.processing_loading_message, self.prompt_context))
+      self.connector.event_channel.post_log_message("warning", message, self.processing_loading_message, self.prompt_context)
 
   def is_error_ignored(self, message):
     if message.endswith("is already in the chat as a read-only file"):
@@ -449,7 +2246,7 @@ class ConnectorInputOutput(InputOutput):
     super().tool_error(message, strip)
     if self.connector and not self.is_error_ignored(message):
       sys.stderr.write(f"ERROR: {message}\n")
-      wait_for_async(self.connector, self.connector.send_log_message("error", message, False, self.prompt_context))
+      self.connector.event_channel.post_log_message("error", message, False, self.prompt_context)
 
   def confirm_ask(
     self,
@@ -473,22 +2270,22 @@ class ConnectorInputOutput(InputOutput):
     if not self.connector:
       return False
 
-    # Reset the result
-    global confirmation_result
-    confirmation_result = None
-
     # Create coroutine for emitting the question
     async def ask_question():
-      await self.connector.sio.emit('message', {
-        'action': 'ask-question',
-        'question': question,
-        'subject': subject,
-        'isGroupQuestion': group is not None,
-        'defaultAnswer': default
-      })
-      while confirmation_result is None:
-        await asyncio.sleep(0.25)
-      return confirmation_result
+      global confirmation_result
+      async with confirmation_lock:
+        # Reset the result
+        confirmation_result = None
+        await self.connector.send_action({
+          'action': 'ask-question',
+          'question': question,
+          'subject': subject,
+          'isGroupQuestion': group is not None,
+          'defaultAnswer': default
+        }, False)
+        while confirmation_result is None:
+          await asyncio.sleep(0.25)
+        return confirmation_result
 
     if result is None:
       result = wait_for_async(self.connector, ask_question())
@@ -498,7 +2295,7 @@ class ConnectorInputOutput(InputOutput):
       coder_for_prompt = self.connector.prompt_executor.get_coder(self.prompt_context.id) if self.prompt_context else None
       if coder_for_prompt: # Ensure we have a valid coder
         # Process architect coder
-        wait_for_async(self.connector, self.connector.send_log_message("loading", "Editing files...", False, self.prompt_context))
+        self.connector.event_channel.post_log_message("loading", "Editing files...", False, self.prompt_context)
         wait_for_async(self.connector, run_editor_coder_stream(coder_for_prompt, self.connector, self.prompt_context))
       return False
 
@@ -517,18 +2314,21 @@ class ConnectorInputOutput(InputOutput):
 
   def reset_state(self, add_command_to_context=None):
     if self.current_command:
-      wait_for_async(self.connector, self.connector.send_action({
+      self.connector.event_channel.post_action({
         "action": "use-command-output",
         "command": self.current_command,
         "addToContext": add_command_to_context if add_command_to_context is not None else self.add_command_to_context,
         "finished": True
-      }))
+      })
 
       self.running_shell_command = False
       self.processing_loading_message = False
       self.current_command = None
 
   def interrupt_input(self):
+    # files have been changed outside of aider
+    self.connector.repo_files_cache.invalidate()
+
     async def process_changes():
       # Generate a new prompt ID for file watcher changes
       await self.connector.prompt_executor.run_prompt(prompt, prompt_context, "code", files=[{"path": file_path, "readOnly": False} for file_path in sorted(self.connector.file_watcher.changed_files)])
@@ -557,9 +2357,196 @@ class ConnectorInputOutput(InputOutput):
         }
         prompt_context = PromptContext(str(uuid.uuid4()), group)
 
-        wait_for_async(self.connector, self.connector.send_log_message("loading", "Processing request...", False, prompt_context))
+        self.connector.event_channel.post_log_message("loading", "Processing request...", False, prompt_context)
         self.connector.loop.create_task(process_changes())
 
+class CommandOutputBuffer:
+  """
+  Keeps the tail of a command output within the given number of characters.
+  """
+
+  def __init__(self, max_chars):
+    self.max_chars = max_chars
+    self.chunks = deque()
+    self.size = 0
+    self.dropped = 0
+
+  def append(self, text):
+    self.chunks.append(text)
+    self.size += len(text)
+    while self.size > self.max_chars and self.chunks:
+      excess = self.size - self.max_chars
+      first = self.chunks[0]
+      if len(first) <= excess:
+        self.chunks.popleft()
+        removed = len(first)
+      else:
+        self.chunks[0] = first[excess:]
+        removed = excess
+      self.size -= removed
+      self.dropped += removed
+
+  def get_text(self):
+    text = "".join(self.chunks)
+    if self.dropped:
+      text = f"... {self.dropped} characters of output omitted ...\n" + text
+    return text
+
+class CommandOutputStream:
+  """
+  Sends the output of a running command to AiderDesk in batched command-output-chunk actions.
+  """
+
+  def __init__(self, io, command, flush_interval=0.1, max_batch_size=16 * 1024):
+    self.io = io
+    self.command = command
+    self.flush_interval = flush_interval
+    self.max_batch_size = max_batch_size
+    self.buffer = CommandOutputBuffer(io.connector.command_output_buffer_size)
+    self.pending = []
+    self.pending_size = 0
+    self.flush_scheduled = False
+    self.lock = threading.Lock()
+
+  def write(self, text):
+    if not text:
+      return
+    loop = self.io.connector.loop
+    with self.lock:
+      self.buffer.append(text)
+      self.pending.append(text)
+      self.pending_size += len(text)
+      if self.pending_size >= self.max_batch_size:
+        flush_now = True
+      else:
+        flush_now = False
+        if not self.flush_scheduled:
+          self.flush_scheduled = True
+          try:
+            loop.call_soon_threadsafe(loop.call_later, self.flush_interval, self.flush)
+          except RuntimeError:
+            # event loop is already closed
+            self.flush_scheduled = False
+    if flush_now:
+      self.flush()
+
+  def flush(self):
+    with self.lock:
+      self.flush_scheduled = False
+      chunk = "".join(self.pending)
+      self.pending = []
+      self.pending_size = 0
+    if chunk:
+      self.io.connector.event_channel.post_action({
+        "action": "command-output-chunk",
+        "command": self.command,
+        "chunk": chunk,
+        "promptContext": {"id": self.io.prompt_context.id, "group": self.io.prompt_context.group} if self.io.prompt_context else None,
+      })
+
+def truncate_command_output(output, model, max_tokens):
+  """
+  Truncates the middle of the output so it fits into max_tokens, keeping mostly its end
+  where errors and test results usually are.
+  """
+  if not output or not max_tokens or not model:
+    return output
+  tokens = model.token_count(output)
+  if tokens <= max_tokens:
+    return output
+
+  keep_chars = int(len(output) * max_tokens / tokens * 0.9)
+  head_chars = keep_chars // 5
+  head = output[:head_chars]
+  head = head[:head.rfind("\n") + 1] if "\n" in head else head
+  tail = output[len(output) - (keep_chars - head_chars):]
+  tail = tail[tail.find("\n") + 1:] if "\n" in tail else tail
+  truncated_lines = output.count("\n") - head.count("\n") - tail.count("\n")
+  return f"{head}... {truncated_lines} lines of output truncated ...\n{tail}"
+
+def run_command_streaming(io, command, cwd=None):
+  """
+  Runs the shell command streaming its output to AiderDesk. Returns (exit_status, output)
+  like aider's run_cmd, the output being limited in memory and in tokens.
+  """
+  connector = io.connector
+  if platform.system() == "Windows" and aider_run_cmd.get_windows_parent_process_name() == "powershell.exe":
+    command = f"powershell -Command {command}"
+
+  stream = CommandOutputStream(io, command)
+  process = subprocess.Popen(
+    command,
+    stdout=subprocess.PIPE,
+    stderr=subprocess.STDOUT,
+    stdin=subprocess.DEVNULL,
+    shell=True,
+    cwd=cwd,
+  )
+  decoder = codecs.getincrementaldecoder(sys.stdout.encoding or "utf-8")(errors="replace")
+  try:
+    while True:
+      data = os.read(process.stdout.fileno(), 64 * 1024)
+      if not data:
+        break
+      stream.write(decoder.decode(data).replace("\r\n", "\n"))
+      if io.cancelled:
+        process.kill()
+        break
+    stream.write(decoder.decode(b"", final=True))
+  finally:
+    process.stdout.close()
+    process.wait()
+    stream.flush()
+
+  connector.metrics.increment("command_output_chars", stream.buffer.size + stream.buffer.dropped)
+  model = connector.coder.main_model if connector.coder else None
+  return process.returncode, truncate_command_output(stream.buffer.get_text(), model, connector.command_output_max_tokens)
+
+def _patched_run_cmd(command, verbose=False, error_print=None, cwd=None):
+  # aider passes io.tool_error as error_print for the commands run for the user
+  io = getattr(error_print, "__self__", None)
+  if not isinstance(io, ConnectorInputOutput) or not io.connector:
+    return original_run_cmd(command, verbose=verbose, error_print=error_print, cwd=cwd)
+
+  connector = io.connector
+  if not connector.has_capability("command-output-chunk"):
+    # AiderDesk reads the command output from stdout, printed by aider's run_cmd
+    exit_status, output = original_run_cmd(command, verbose=verbose, error_print=error_print, cwd=cwd)
+    model = connector.coder.main_model if connector.coder else None
+    return exit_status, truncate_command_output(output, model, connector.command_output_max_tokens)
+
+  try:
+    return run_command_streaming(io, command, cwd)
+  except OSError as e:
+    error_message = f"Error occurred while running command '{command}': {str(e)}"
+    error_print(error_message)
+    return 1, error_message
+
+original_run_cmd = aider_run_cmd.run_cmd
+
+def patch_run_cmd():
+  # run_cmd is imported by name into the modules running shell commands
+  aider_commands.run_cmd = _patched_run_cmd
+  aider_base_coder.run_cmd = _patched_run_cmd
+
+# state of the repo call running in the current thread, see Connector.monkey_patch_repo_functions
+repo_call_context = threading.local()
+
+def get_provisional_commit_message(diffs):
+  fnames = []
+  for line in (diffs or "").splitlines():
+    if line.startswith("+++ b/"):
+      fnames.append(line[6:])
+    elif line.startswith("Added "):
+      fnames.append(line[6:])
+  fnames = list(dict.fromkeys(os.path.basename(fname) for fname in fnames))
+
+  if not fnames:
+    return "chore: update files"
+  if len(fnames) > 3:
+    return f"chore: update {', '.join(fnames[:3])} and {len(fnames) - 3} more"
+  return f"chore: update {', '.join(fnames)}"
+
 def clone_coder(connector, coder, prompt_context=None, messages=None, files=None, **kwargs):
   kwargs["from_coder"] = coder
   kwargs["summarize_from_coder"] = False
@@ -569,7 +2556,7 @@ def clone_coder(connector, coder, prompt_context=None, messages=None, files=None
   connector.monkey_patch_coder_functions(coder)
 
   if coder.repo:
-    connector.monkey_patch_repo_functions(coder.repo, prompt_context)
+    connector.monkey_patch_repo_functions(coder.repo)
 
   if messages is not None:
     # Set messages from the provided data
@@ -634,13 +2621,293 @@ def create_io(connector, coder, prompt_context=None):
 
   return io
 
+class Transport(abc.ABC):
+  """
+  Connection to AiderDesk. Calls on_connect, on_message and on_disconnect of its handler
+  (the Connector) and sends events with emit.
+  """
+
+  def __init__(self):
+    self.handler = None
+
+  @property
+  @abc.abstractmethod
+  def connected(self):
+    pass
+
+  @abc.abstractmethod
+  async def connect(self):
+    pass
+
+  @abc.abstractmethod
+  async def wait(self):
+    pass
+
+  @abc.abstractmethod
+  async def emit(self, event, data):
+    pass
+
+class SocketIOTransport(Transport):
+  """Socket.IO over HTTP, optionally connecting directly with websocket without long polling."""
+
+  def __init__(self, server_url, websocket_only=False):
+    super().__init__()
+    self.server_url = server_url
+    self.websocket_only = websocket_only
+    self.sio = socketio.AsyncClient()
+
+    @self.sio.event
+    async def connect():
+      await self.handler.on_connect()
+
+    @self.sio.on("message")
+    async def on_message(data):
+      await self.handler.on_message(data)
+
+    @self.sio.event
+    async def disconnect():
+      await self.handler.on_disconnect()
+
+  @property
+  def connected(self):
+    return self.sio.connected
+
+  async def connect(self):
+    await self.sio.connect(self.server_url, transports=["websocket"] if self.websocket_only else None)
+
+  async def wait(self):
+    await self.sio.wait()
+
+  async def emit(self, event, data):
+    await self.sio.emit(event, data)
+
+def redirect_stdout_to_stderr():
+  """Redirects everything printed to stdout to stderr, returns a file descriptor of the original stdout."""
+  sys.stdout.flush()
+  stdout_fd = os.dup(sys.stdout.fileno())
+  os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+  return stdout_fd
+
+class FramedTransport(Transport):
+  """
+  Exchanges length-prefixed frames over a local stream: a 4 byte big-endian length followed
+  by the UTF-8 JSON of {"event": ..., "data": ...}.
+  """
+
+  max_frame_size = 256 * 1024 * 1024
+
+  def __init__(self):
+    super().__init__()
+    self.reader = None
+    self.writer = None
+    self.read_task = None
+    self.write_lock = asyncio.Lock()
+
+  @property
+  def connected(self):
+    return self.writer is not None
+
+  @abc.abstractmethod
+  async def open(self):
+    """Returns the (reader, writer) of the stream."""
+
+  async def connect(self):
+    self.reader, self.writer = await self.open()
+    self.read_task = asyncio.create_task(self._read_frames())
+    await self.handler.on_connect()
+
+  async def emit(self, event, data):
+    writer = self.writer
+    if writer is None:
+      raise ConnectionError("Not connected to AiderDesk")
+    payload = json.dumps({"event": event, "data": data}).encode("utf-8")
+    async with self.write_lock:
+      writer.write(struct.pack(">I", len(payload)) + payload)
+      await writer.drain()
+
+  async def _read_frames(self):
+    try:
+      while True:
+        size, = struct.unpack(">I", await self.reader.readexactly(4))
+        if size > self.max_frame_size:
+          raise ConnectionError(f"Frame of {size} bytes exceeds the limit")
+        frame = json.loads(await self.reader.readexactly(size))
+        if frame.get("event") == "message":
+          # handled concurrently, like Socket.IO event handlers
+          asyncio.create_task(self.handler.on_message(frame.get("data")))
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+      if not isinstance(e, asyncio.IncompleteReadError):
+        sys.stderr.write(f"Transport error: {str(e)}\n")
+    finally:
+      writer = self.writer
+      self.writer = None
+      if writer is not None:
+        writer.close()
+      await self.handler.on_disconnect()
+
+class UnixSocketTransport(FramedTransport):
+  """Framed transport over a Unix domain socket, reconnecting when the connection drops."""
+
+  def __init__(self, path, reconnection_delay=1.0, max_reconnection_delay=5.0):
+    super().__init__()
+    self.path = path
+    self.reconnection_delay = reconnection_delay
+    self.max_reconnection_delay = max_reconnection_delay
+
+  async def open(self):
+    return await asyncio.open_unix_connection(self.path)
+
+  async def wait(self):
+    while True:
+      await self.read_task
+      delay = self.reconnection_delay
+      while True:
+        await asyncio.sleep(delay)
+        try:
+          await self.connect()
+          break
+        except OSError:
+          delay = min(delay * 2, self.max_reconnection_delay)
+
+class StdioTransport(FramedTransport):
+  """
+  Framed transport over stdin and stdout of the connector process. Output printed by aider
+  is redirected to stderr from the start, so it does not corrupt the frames.
+  """
+
+  def __init__(self):
+    super().__init__()
+    self.frames_fd = redirect_stdout_to_stderr()
+
+  async def open(self):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=self.max_frame_size)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin.buffer)
+
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, os.fdopen(self.frames_fd, "wb"))
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
+  async def wait(self):
+    # AiderDesk closing stdin ends the connector
+    await self.read_task
+
+class HeadlessTransport(Transport):
+  """
+  Runs the connector without AiderDesk: reads actions from a JSONL file (or stdin) and
+  writes every outbound event as a JSONL record with a timestamp (to stdout by default, with
+  aider's prints redirected to stderr).
+
+  Questions are answered with the given answer, or their default one. Input actions are
+  processed one after another, optionally waiting for the prompts of each to finish, and
+  the run ends once the input is read and all prompts are finished.
+  """
+
+  def __init__(self, input_path="-", output_path="-", answer=None, sequential=False):
+    super().__init__()
+    self.input_path = input_path
+    self.output_path = output_path
+    self.answer = answer
+    self.sequential = sequential
+    self.input = None
+    self.output = None
+    self.write_lock = threading.Lock()
+    # aider prints while the connector is created
+    self.output_fd = redirect_stdout_to_stderr() if output_path == "-" else None
+
+  @property
+  def connected(self):
+    return self.output is not None
+
+  async def connect(self):
+    if self.output_fd is not None:
+      self.output = os.fdopen(self.output_fd, "w", encoding="utf-8")
+    else:
+      self.output = open(self.output_path, "w", encoding="utf-8")
+    self.input = sys.stdin if self.input_path == "-" else open(self.input_path, encoding="utf-8")
+    await self.handler.on_connect()
+
+  async def emit(self, event, data):
+    if self.output is None:
+      raise ConnectionError("Headless run has finished")
+    record = {
+      "timestamp": datetime.now().astimezone().isoformat(timespec="milliseconds"),
+      "event": event,
+      "data": data,
+    }
+    with self.write_lock:
+      self.output.write(json.dumps(record) + "\n")
+      self.output.flush()
+
+    if event == "message" and isinstance(data, dict) and data.get("action") == "ask-question":
+      answer = self.answer or data.get("defaultAnswer") or "y"
+      asyncio.create_task(self.handler.process_message({"action": "answer-question", "answer": answer}))
+
+  async def wait_for_prompts(self):
+    prompt_executor = self.handler.prompt_executor
+    while prompt_executor.active_prompts or prompt_executor.active_batches:
+      await asyncio.gather(*prompt_executor.active_prompts.values(), *prompt_executor.active_batches.values(), return_exceptions=True)
+
+  async def wait(self):
+    try:
+      while True:
+        line = await asyncio.to_thread(self.input.readline)
+        if not line:
+          break
+        line = line.strip()
+        if not line:
+          continue
+        try:
+          message = json.loads(line)
+        except ValueError as e:
+          sys.stderr.write(f"Invalid input line: {str(e)}\n")
+          continue
+
+        if message.get("action") == "prompt" and not message.get("promptContext"):
+          message["promptContext"] = {"id": str(uuid.uuid4())}
+        await self.handler.process_message(message)
+        if self.sequential:
+          await self.wait_for_prompts()
+
+      await self.wait_for_prompts()
+      await self.handler.event_channel.flush()
+      await self.handler.log_aggregator.flush()
+      await self.handler.outbound.flush()
+      await self.handler.on_disconnect()
+    finally:
+      if self.input is not sys.stdin:
+        self.input.close()
+      output = self.output
+      self.output = None
+      output.close()
+
+def create_transport(kind, server_url=None, socket_path=None, headless_options=None):
+  if kind == "socketio":
+    return SocketIOTransport(server_url)
+  if kind == "websocket":
+    return SocketIOTransport(server_url, websocket_only=True)
+  if kind == "unix":
+    if not socket_path:
+      raise ValueError("Socket path is required for unix transport")
+    return UnixSocketTransport(socket_path)
+  if kind == "stdio":
+    return StdioTransport()
+  if kind == "headless":
+    return HeadlessTransport(**(headless_options or {}))
+  raise ValueError(f"Unknown transport: {kind}")
+
 class Connector:
-  def __init__(self, base_dir, watch_files=False, server_url="http://localhost:24337", reasoning_effort=None, thinking_tokens=None, confirm_before_edit=False):
+  def __init__(self, base_dir, watch_files=False, server_url="http://localhost:24337", reasoning_effort=None, thinking_tokens=None, confirm_before_edit=False, memory_budget=None, repo_map_processes=0, cache_dir=None, async_commit_messages=False, command_output_max_tokens=None, command_output_buffer_size=1024 * 1024, resume_grace_period=None, repo_map_budget=None, http_pool_options=None, llm_cache_size=None, summarize_history_tokens=None, transport=None, prompt_batch_concurrency=4):
     self.base_dir = base_dir
+    self.async_commit_messages = async_commit_messages
+    # limits of the shell command output kept in memory and added to the chat
+    self.command_output_max_tokens = command_output_max_tokens
+    self.command_output_buffer_size = command_output_buffer_size
     self.server_url = server_url
     self.reasoning_effort = reasoning_effort
     self.thinking_tokens = thinking_tokens
     self.confirm_before_edit = confirm_before_edit
+    self.prompt_batch_concurrency = prompt_batch_concurrency
 
     try:
       self.loop = asyncio.get_event_loop()
@@ -648,6 +2915,28 @@ class Connector:
       self.loop = asyncio.new_event_loop()
       asyncio.set_event_loop(self.loop)
 
+    self.metrics = ConnectorMetrics()
+    self.event_channel = EventChannel(self)
+    self.outbound = OutboundScheduler(self)
+    self.log_aggregator = LogAggregator(self)
+    self.file_cache = FileContentCache(metrics=self.metrics)
+
+    # Shared by all coders to avoid walking the git tree on every call
+    self.repo_files_cache = RepoFilesCache()
+
+    # Stream output of shell commands run by coders
+    patch_run_cmd()
+
+    cache_dir = cache_dir or get_default_cache_dir()
+    self.llm_response_cache = None
+    if llm_cache_size:
+      self.llm_response_cache = LLMResponseCache(
+        os.path.join(cache_dir, "llm-responses"),
+        llm_cache_size,
+        metrics=self.metrics
+      )
+      patch_simple_send_with_retries()
+
     # Create initial coder for setup and non-prompt operations
     self.coder = create_base_coder(self)
     if reasoning_effort is not None:
@@ -658,13 +2947,46 @@ class Connector:
     self.coder.pretty = False
     self.monkey_patch_coder_functions(self.coder)
 
+    self.http_pool = HttpClientPool.install(self.metrics, **(http_pool_options or {})) if http_pool_options is not False else None
+
     create_io(self, self.coder)
 
     # Initialize prompt executor
-    self.prompt_executor = PromptExecutor(self)
+    self.prompt_executor = PromptExecutor(self, memory_budget=memory_budget)
 
     self.current_tokenization_task = None
 
+    self.session_history = SessionHistoryStore()
+    self.repo_map_worker = RepoMapWorker(repo_map_processes) if repo_map_processes > 0 else None
+    self.context_snapshot = ContextSnapshot(base_dir, cache_dir)
+    self.context_snapshot_save_handle = None
+    self.file_token_estimator = FileTokenEstimator()
+    self.token_accounting = TokenAccounting()
+    self.history_summarizer = HistorySummarizer(self, summarize_history_tokens) if summarize_history_tokens else None
+    self.model_cache = ModelCache()
+    # serializes git commits of concurrent prompts
+    self.git_lock = threading.RLock()
+    # prompt ID -> future of the commit message being generated for its last commit
+    self.pending_commit_messages: Dict[str, Future] = {}
+    # capabilities confirmed by AiderDesk via set-capabilities action
+    self.enabled_capabilities = set()
+    self.history_writers: Dict[str, HistoryWriter] = {}
+    self.history_writers_lock = threading.Lock()
+
+    # resumable mode keeps prompts running while disconnected for the grace period
+    self.resume_grace_period = resume_grace_period
+    self.replay_buffer = ReplayBuffer() if resume_grace_period else None
+    self.last_delivered_seq = 0
+    self.resume_pending = False
+    self.resume_timeout_handle = None
+    self.disconnect_grace_task = None
+
+    # seconds to wait for a repo map before using a partial one
+    self.repo_map_budget = repo_map_budget
+    self.repo_map_tasks: Dict[tuple, asyncio.Future] = {}
+    self.repo_map_results: "OrderedDict[tuple, Optional[str]]" = OrderedDict()
+    atexit.register(self.close_history_writers)
+
     if watch_files:
       ignores = []
       if self.coder.root:
@@ -675,8 +2997,8 @@ class Connector:
       self.file_watcher = FileWatcher(self.coder, gitignores=ignores)
       self.file_watcher.start()
 
-    self.sio = socketio.AsyncClient()
-    self._register_events()
+    self.transport = transport or SocketIOTransport(server_url)
+    self.transport.handler = self
 
   def monkey_patch_coder_functions(self, coder, prompt_context=None):
     # self here is the Connector instance
@@ -685,16 +3007,27 @@ class Connector:
     original_lint_edited = coder.lint_edited
     def _patched_lint_edited(coder_instance, fnames):
       # Add loading message before linting
-      wait_for_async(self, self.send_log_message("loading", "Linting...", False, prompt_context))
+      self.event_channel.post_log_message("loading", "Linting...", False, prompt_context)
       # Call the original Coder.lint_edited logic
       result = original_lint_edited(fnames)
       # Finish the loading message after linting
-      wait_for_async(self, self.send_log_message("loading", "Linting...", True, prompt_context))
+      self.event_channel.post_log_message("loading", "Linting...", True, prompt_context)
       return result
 
     # Replace the original lint_edited method with the patched version
     coder.lint_edited = types.MethodType(_patched_lint_edited, coder)
 
+    original_get_all_relative_files = coder.get_all_relative_files
+    def _patched_get_all_relative_files(coder_instance):
+      return self.repo_files_cache.get_relative_files(coder_instance, original_get_all_relative_files)
+
+    def _patched_get_all_abs_files(coder_instance):
+      return self.repo_files_cache.get_abs_files(coder_instance, original_get_all_relative_files)
+
+    # Use the shared repository file listing cache
+    coder.get_all_relative_files = types.MethodType(_patched_get_all_relative_files, coder)
+    coder.get_all_abs_files = types.MethodType(_patched_get_all_abs_files, coder)
+
     if self.confirm_before_edit:
       # Monkey patch prepare_to_edit to add confirmation if enabled
       original_prepare_to_edit = coder.prepare_to_edit
@@ -742,38 +3075,133 @@ class Connector:
     # Replace the original run_shell_commands method with the patched version
     coder.run_shell_commands = types.MethodType(_patched_run_shell_commands, coder)
 
-  def monkey_patch_repo_functions(self, repo, prompt_context=None):
+  def monkey_patch_repo_functions(self, repo):
     if not repo:
       return
 
-    # patch repo.get_commit_message to send a loading message while generating commit message
+    # the repo is shared by all coders cloned from the base coder, so it is patched only once
+    # and the prompt context of the current commit is passed in thread local storage
+    if getattr(repo, 'connector_patched', False):
+      return
+    repo.connector_patched = True
+
+    original_commit = repo.commit
     original_get_commit_message = repo.get_commit_message
 
-    def _patched_get_commit_message(repo_instance, diffs, context, user_language=None):
-      wait_for_async(self, self.send_log_message("loading", "Generating commit message...", False, prompt_context))
-      result = original_get_commit_message(diffs, context, user_language)
-      wait_for_async(self, self.send_log_message("loading", "Generating commit message...", True, prompt_context))
+    def generate_commit_message(diffs, context, user_language, prompt_context):
+      self.event_channel.post_log_message("loading", "Generating commit message...", False, prompt_context)
+      # commit messages of the same diff can be reused, e.g. after undo
+      llm_call_context.response_cache = self.llm_response_cache
+      try:
+        return original_get_commit_message(diffs, context, user_language)
+      finally:
+        llm_call_context.response_cache = None
+        self.event_channel.post_log_message("loading", "Generating commit message...", True, prompt_context)
+
+    def _patched_commit(repo_instance, fnames=None, context=None, message=None, aider_edits=False, coder=None):
+      io = coder.io if coder else None
+      prompt_context = io.prompt_context if isinstance(io, ConnectorInputOutput) else None
+      prompt_id = prompt_context.id if prompt_context else None
+      pending_commit_message = self.pending_commit_messages.get(prompt_id)
+      if pending_commit_message:
+        # the previous commit of the prompt can be amended only while it is the last commit
+        pending_commit_message.result()
+
+      repo_call_context.prompt_context = prompt_context
+      repo_call_context.in_commit = True
+      repo_call_context.deferred_commit_message = None
+      try:
+        # concurrent prompts must not commit at the same time
+        with self.git_lock:
+          result = original_commit(fnames, context, message, aider_edits, coder)
+      finally:
+        repo_call_context.in_commit = False
+
+      deferred_commit_message = repo_call_context.deferred_commit_message
+      repo_call_context.deferred_commit_message = None
+      if result and deferred_commit_message:
+        future = self.prompt_executor.get_executor().submit(
+          self.finalize_commit_message, repo, coder, result, generate_commit_message, *deferred_commit_message
+        )
+        self.pending_commit_messages[prompt_id] = future
+
+        def _on_commit_message_done(done_future):
+          if self.pending_commit_messages.get(prompt_id) is done_future:
+            del self.pending_commit_messages[prompt_id]
+
+        future.add_done_callback(_on_commit_message_done)
 
       return result
 
+    def _patched_get_commit_message(repo_instance, diffs, context, user_language=None):
+      prompt_context = getattr(repo_call_context, 'prompt_context', None)
+
+      if self.async_commit_messages and getattr(repo_call_context, 'in_commit', False):
+        # commit with a provisional message now, generate the real one in the background
+        provisional_message = get_provisional_commit_message(diffs)
+        repo_call_context.deferred_commit_message = (provisional_message, diffs, context, user_language, prompt_context)
+        return provisional_message
+
+      return generate_commit_message(diffs, context, user_language, prompt_context)
+
+    repo.commit = types.MethodType(_patched_commit, repo)
     repo.get_commit_message = types.MethodType(_patched_get_commit_message, repo)
 
-  def _register_events(self):
-    @self.sio.event
-    async def connect():
-      await self.on_connect()
+  def finalize_commit_message(self, repo, coder, commit_result, generate_commit_message, provisional_message, diffs, context, user_language, prompt_context):
+    """Generates the commit message and amends the commit made with the provisional message."""
+    commit_hash, shown_commit_message = commit_result
+    try:
+      commit_message = generate_commit_message(diffs, context, user_language, prompt_context)
+      if not commit_message:
+        return
 
-    @self.sio.on("message")
-    async def on_message(data):
-      await self.on_message(data)
+      with self.git_lock:
+        head = repo.repo.head.commit
+        if repo.get_head_commit_sha(short=True) != commit_hash:
+          self.event_channel.post_log_message("warning", f"Commit {commit_hash} is not the last commit anymore, keeping its provisional message.", False, prompt_context)
+          return
 
-    @self.sio.event
-    async def disconnect():
-      await self.on_disconnect()
+        # keep the prefix and trailer added by aider
+        full_commit_message = head.message.replace(provisional_message, commit_message, 1)
+        cmd = ["--amend", "-m", full_commit_message]
+        if not repo.git_commit_verify:
+          cmd.append("--no-verify")
+        repo.repo.git.commit(cmd, env={
+          "GIT_COMMITTER_NAME": head.committer.name,
+          "GIT_COMMITTER_EMAIL": head.committer.email,
+        })
+        new_commit_hash = repo.get_head_commit_sha(short=True)
+
+      # aider_commit_hashes set is shared with the base coder, needed for /undo
+      if coder and commit_hash in coder.aider_commit_hashes:
+        coder.aider_commit_hashes.discard(commit_hash)
+        coder.aider_commit_hashes.add(new_commit_hash)
+      shown_commit_message = shown_commit_message.replace(provisional_message, commit_message, 1)
+      if coder and coder.last_aider_commit_hash == commit_hash:
+        coder.last_aider_commit_hash = new_commit_hash
+        coder.last_aider_commit_message = shown_commit_message
+
+      self.event_channel.post_action({
+        "action": "commit-updated",
+        "oldCommitHash": commit_hash,
+        "commitHash": new_commit_hash,
+        "commitMessage": shown_commit_message,
+        "promptContext": {"id": prompt_context.id, "group": prompt_context.group} if prompt_context else None,
+      })
+    except Exception as e:
+      self.event_channel.post_log_message("error", f"Unable to update commit message of {commit_hash}: {str(e)}", False, prompt_context)
 
   async def on_connect(self):
     """Handle connection event."""
     self.coder.io.tool_output("---- AIDER CONNECTOR CONNECTED TO AIDER DESK ----")
+    if self.disconnect_grace_task:
+      self.disconnect_grace_task.cancel()
+      self.disconnect_grace_task = None
+      if self.has_capability("resume"):
+        # hold the buffered events until AiderDesk tells which ones it has received
+        self.resume_pending = True
+        self.resume_timeout_handle = self.loop.call_later(5, lambda: asyncio.ensure_future(self.resume(None)))
+    self.enabled_capabilities = set()
 
     await self.send_action({
       "action": "init",
@@ -781,18 +3209,29 @@ class Connector:
       "baseDir": self.base_dir,
       "listenTo": [
         "prompt",
+        "prompt-batch",
         "answer-question",
         "set-models",
         "request-context-info",
         "run-command",
         "interrupt-response",
         "apply-edits",
-        "update-env-vars"
+        "update-env-vars",
+        "set-capabilities",
+        "request-metrics",
+        "resume"
       ],
+      "capabilities": [
+        "session-history",
+        "add-files",
+        "add-messages",
+        "command-output-chunk"
+      ] + (["resume"] if self.replay_buffer is not None else []),
       "contextFiles": self.get_context_files(),
       "inputHistoryFile": self.coder.io.input_history_file
     })
     await self.send_current_models()
+    await self.send_context_snapshot()
 
   def _tokenize_files_sync(self, root, rel_fnames, addable_rel_fnames, encoding, abs_read_only_fnames):
     """Synchronous helper function for file tokenization."""
@@ -819,6 +3258,20 @@ class Connector:
     """Handle disconnection event."""
     self.coder.io.tool_output("AIDER CONNECTOR DISCONNECTED FROM AIDER DESK")
 
+    if self.replay_buffer is not None:
+      # keep the prompts running, AiderDesk may reconnect and resume
+      if self.resume_timeout_handle:
+        self.resume_timeout_handle.cancel()
+        self.resume_timeout_handle = None
+      self.resume_pending = False
+      if not self.disconnect_grace_task:
+        self.disconnect_grace_task = asyncio.create_task(self.cancel_prompts_after_grace_period())
+    else:
+      await self.cancel_prompts()
+
+    await asyncio.get_running_loop().run_in_executor(None, self.flush_history_writers)
+
+  async def cancel_prompts(self):
     # Shutdown prompt executor
     if self.prompt_executor:
       await self.prompt_executor.shutdown()
@@ -826,37 +3279,124 @@ class Connector:
     if self.current_tokenization_task and not self.current_tokenization_task.done():
       self.current_tokenization_task.cancel()
 
+  async def cancel_prompts_after_grace_period(self):
+    await asyncio.sleep(self.resume_grace_period)
+    if not self.transport.connected:
+      self.coder.io.tool_output("Resume grace period expired, cancelling running prompts")
+      await self.cancel_prompts()
+
+  async def resume(self, last_seq):
+    """
+    Replays the events after last_seq, or after the last delivered event when AiderDesk
+    did not send it, then continues with the live events.
+    """
+    if self.replay_buffer is None:
+      return
+    if self.resume_timeout_handle:
+      self.resume_timeout_handle.cancel()
+      self.resume_timeout_handle = None
+    if last_seq is None:
+      last_seq = self.last_delivered_seq
+
+    events, complete = self.replay_buffer.get_events_after(last_seq)
+    replayed = 0
+    while events:
+      for event, data in events:
+        await self.transport.emit(event, data)
+        last_seq = data["seq"]
+        replayed += 1
+      # events may have been added while replaying
+      events, _ = self.replay_buffer.get_events_after(last_seq)
+    self.last_delivered_seq = max(self.last_delivered_seq, last_seq)
+    self.replay_buffer.acknowledge(self.last_delivered_seq)
+    self.resume_pending = False
+    self.metrics.increment("resume_replayed_events", replayed)
+
+    await self.send_action({
+      "action": "resumed",
+      "replayed": replayed,
+      "complete": complete
+    })
+
   async def connect(self):
     """Connect to the server."""
-    await self.sio.connect(self.server_url)
+    await self.transport.connect()
 
   async def wait(self):
     """Wait for events."""
-    await self.sio.wait()
+    await self.transport.wait()
 
   async def start(self):
     await self.connect()
     await self.wait()
 
+  def get_history_writer(self, path, encoding="utf-8", errors="strict"):
+    key = str(path)
+    with self.history_writers_lock:
+      writer = self.history_writers.get(key)
+      if writer is None:
+        writer = self.history_writers[key] = HistoryWriter(path, encoding=encoding, errors=errors)
+      return writer
+
+  def flush_history_writers(self):
+    for writer in list(self.history_writers.values()):
+      writer.flush()
+
+  def close_history_writers(self):
+    for writer in list(self.history_writers.values()):
+      writer.close()
+
+  def warm_up_http_pool(self):
+    if not self.http_pool:
+      return
+    main_model = self.coder.main_model
+    model_names = [main_model.name]
+    if main_model.weak_model:
+      model_names.append(main_model.weak_model.name)
+    if main_model.editor_model:
+      model_names.append(main_model.editor_model.name)
+    self.loop.run_in_executor(None, self.http_pool.warm_up, model_names)
+
+  def has_capability(self, capability):
+    return capability in self.enabled_capabilities
+
+  async def transport_emit(self, event, data):
+    seq = data.get("seq") if self.replay_buffer is not None and isinstance(data, dict) else None
+    if seq is None:
+      await self.transport.emit(event, data)
+      return
+
+    if self.resume_pending or not self.transport.connected:
+      # kept in the replay buffer until AiderDesk resumes
+      return
+    if seq <= self.last_delivered_seq:
+      # already delivered by the replay after resume
+      return
+    try:
+      await self.transport.emit(event, data)
+      self.last_delivered_seq = max(self.last_delivered_seq, seq)
+      self.replay_buffer.acknowledge(self.last_delivered_seq)
+    except (socketio.exceptions.SocketIOError, ConnectionError):
+      # disconnected while sending, the event will be replayed
+      pass
+
+  async def emit(self, event, data, wait=True):
+    if event != "log":
+      # loading messages held back by the log aggregator must not arrive after later actions
+      await self.log_aggregator.flush_loading()
+    await self.outbound.send(event, data, wait)
+
   async def send_action(self, action, with_delay = True):
-    await self.sio.emit('message', action)
+    # keep the order with events enqueued from worker threads
+    await self.event_channel.flush()
+    # actions sent without delay (e.g. streamed chunks) do not wait for the socket
+    await self.emit('message', action, with_delay)
     if with_delay:
       await asyncio.sleep(0.01)
 
   async def send_log_message(self, level, message, finished=False, prompt_context=None):
-    payload = {
-      "level": level,
-      "message": message,
-      "finished": finished
-    }
-
-    if prompt_context:
-      payload["promptContext"] = {
-        "id": prompt_context.id,
-        "group": prompt_context.group if hasattr(prompt_context, 'group') else None
-      }
-
-    await self.sio.emit("log", payload)
+    await self.event_channel.flush()
+    await self.log_aggregator.send(build_log_payload(level, message, finished, prompt_context))
     await asyncio.sleep(0.01)
 
   async def process_message(self, message):
@@ -872,15 +3412,49 @@ class Connector:
         mode = message.get('mode')
         architect_model = message.get('architectModel')
         prompt_context_data = message.get('promptContext')
-        messages = message.get('messages', [])
         files = message.get('files', [])
 
         if not prompt:
           return
 
+        messages = await self.resolve_messages(message)
+        if messages is None:
+          return
+
+        if self.history_summarizer:
+          self.history_summarizer.schedule(messages)
+          messages = self.history_summarizer.apply(messages)
+
         prompt_context = PromptContext(prompt_context_data.get('id'), prompt_context_data.get('group'))
         await self.prompt_executor.run_prompt(prompt, prompt_context, mode, architect_model, messages, files)
 
+      elif action == "prompt-batch":
+        tasks = [task for task in message.get('tasks') or [] if task.get('prompt')]
+        if not tasks:
+          return
+
+        messages = await self.resolve_messages(message)
+        if messages is None:
+          return
+
+        if self.history_summarizer:
+          self.history_summarizer.schedule(messages)
+          messages = self.history_summarizer.apply(messages)
+
+        await self.prompt_executor.run_prompt_batch(
+          message.get('batchId') or str(uuid.uuid4()),
+          tasks,
+          mode=message.get('mode'),
+          architect_model=message.get('architectModel'),
+          messages=messages,
+          files=message.get('files', []),
+          concurrency=message.get('concurrency') or self.prompt_batch_concurrency,
+          group=(message.get('promptContext') or {}).get('group'),
+        )
+
+      elif action == "set-capabilities":
+        self.enabled_capabilities = set(message.get('capabilities') or [])
+
       elif action == "answer-question":
         global confirmation_result
         confirmation_result = message.get('answer')
@@ -893,7 +3467,7 @@ class Connector:
           if not main_model:
             return
 
-          model = models.Model(main_model, weak_model=weak_model)
+          model = self.model_cache.get(main_model, weak_model=weak_model)
 
           if not edit_format:
             edit_format = "diff"
@@ -903,22 +3477,26 @@ class Connector:
 
           self.coder = clone_coder(self, self.coder, main_model=model, edit_format=edit_format)
 
-          await asyncio.to_thread(models.sanity_check_models, self.coder.io, model)
+          await asyncio.to_thread(self.model_cache.sanity_check_models, self.coder.io, model)
 
           for line in self.coder.get_announcements():
             self.coder.io.tool_output(line)
 
           await self.send_current_models()
+          self.warm_up_http_pool()
         except Exception as e:
           self.coder.io.tool_error(f"Error setting models: {str(e)}")
 
       elif action == "run-command":
         command = message.get('command')
-        messages = message.get('messages', [])
         files = message.get('files', [])
         if not command:
           return
 
+        messages = await self.resolve_messages(message)
+        if messages is None:
+          return
+
         await self.run_command(command, messages, files)
 
       elif action == "interrupt-response":
@@ -940,12 +3518,25 @@ class Connector:
         if environment_variables:
           await self.update_environment_variables(environment_variables)
 
-          main_model = models.Model(self.coder.main_model.name, weak_model=self.coder.main_model.weak_model.name)
+          main_model = self.model_cache.get(self.coder.main_model.name, weak_model=self.coder.main_model.weak_model.name)
           self.coder.main_model = main_model
 
+      elif action == "resume":
+        await self.resume(message.get("lastSeq"))
+      elif action == "request-metrics":
+        metrics = self.metrics.snapshot()
+        if self.http_pool:
+          metrics["httpPool"] = self.http_pool.get_stats()
+        await self.send_action({
+          "action": "metrics",
+          "metrics": metrics
+        })
+
       elif action == "request-context-info":
-        messages = message.get('messages')
         files = message.get('files')
+        messages = await self.resolve_messages(message)
+        if messages is None:
+          return
         await self.send_tokens_info(messages, files)
         await self.send_repo_map()
         await self.send_autocompletion(files)
@@ -954,6 +3545,48 @@ class Connector:
       self.coder.io.tool_error(f"Exception in connector: {str(e)}")
       return
 
+  async def resolve_messages(self, message):
+    """
+    Resolves the chat history of an incoming action.
+
+    Actions with a `sessionId` either carry the full `messages` (which resyncs the stored
+    session history) or only a `history` delta with `baseVersion`, `baseHash` and the new
+    `messages`. When the delta does not match the stored history, a `history-resync` action
+    is sent and None is returned, so the UI can send the action again with full history.
+    """
+    session_id = message.get('sessionId')
+    history_delta = message.get('history')
+
+    if not session_id:
+      return message.get('messages') or []
+
+    if history_delta is None:
+      history = self.session_history.replace(session_id, message.get('messages') or [])
+    else:
+      history = self.session_history.extend(
+        session_id,
+        history_delta.get('baseVersion'),
+        history_delta.get('baseHash'),
+        history_delta.get('messages') or [],
+      )
+      if history is None:
+        await self.send_action({
+          "action": "history-resync",
+          "sessionId": session_id,
+          "request": message.get('action'),
+          "promptContext": message.get('promptContext'),
+        })
+        return None
+
+    await self.send_action({
+      "action": "history-synced",
+      "sessionId": session_id,
+      "version": history.version,
+      "hash": history.hash,
+    }, False)
+
+    return list(history.messages)
+
   async def update_environment_variables(self, environment_variables):
     """Update environment variables for the Aider process"""
     try:
@@ -969,7 +3602,13 @@ class Connector:
     command_coder.io = self.coder.io
 
     if command.strip() == "/map":
-      repo_map = command_coder.repo_map.get_repo_map(set(), command_coder.get_all_abs_files()) if command_coder.repo_map else None
+      async def send_refined_repo_map(refined_repo_map):
+        if refined_repo_map:
+          await self.send_log_message("info", refined_repo_map)
+
+      repo_map, partial = await self.get_repo_map_within_budget(command_coder, set(), command_coder.get_all_abs_files(), send_refined_repo_map)
+      if partial:
+        await self.send_log_message("info", "Repo map is still being built, showing a partial one.")
       if repo_map:
         await self.send_log_message("info", repo_map)
       else:
@@ -1011,6 +3650,7 @@ class Connector:
     command_coder.io.reset_state(False)
 
     if command.startswith("/map-refresh"):
+      self.repo_files_cache.invalidate()
       await self.send_log_message("info", "The repo map has been refreshed.")
       await self.send_repo_map()
     elif command.startswith("/reasoning-effort"):
@@ -1025,6 +3665,32 @@ class Connector:
         self.thinking_tokens = None
       await self.send_current_models()
 
+  def get_head_commit(self):
+    try:
+      return self.coder.repo.get_head_commit_sha() if self.coder.repo else None
+    except Exception:
+      return None
+
+  async def send_context_snapshot(self):
+    """Sends the last context info computed for the current git HEAD."""
+    actions = await asyncio.to_thread(self.context_snapshot.load, self.get_head_commit())
+    for action in actions.values():
+      await self.send_action(dict(action, snapshot=True), False)
+
+  async def send_context_action(self, kind, action):
+    """Sends the context info action only if it changed since last time."""
+    if not self.context_snapshot.update(kind, action, self.get_head_commit()):
+      return
+
+    await self.send_action(action)
+
+    # debounce saving, context info is usually sent in bursts
+    if self.context_snapshot_save_handle:
+      self.context_snapshot_save_handle.cancel()
+    self.context_snapshot_save_handle = self.loop.call_later(
+      1.0, lambda: self.loop.run_in_executor(None, self.context_snapshot.save)
+    )
+
   async def send_autocompletion(self, files):
     try:
       # Use all files from files parameter and convert to relative paths
@@ -1039,9 +3705,11 @@ class Connector:
         rel_fnames.append(relative_path)
       all_models = sorted(set(models.fuzzy_match_models("") + [model_settings.name for model_settings in models.MODEL_SETTINGS]))
 
-      await self.send_action({
+      # keep the last known words until the files are tokenized
+      last_autocompletion = self.context_snapshot.get("autocompletion") or {}
+      await self.send_context_action("autocompletion", {
         "action": "update-autocompletion",
-        "words": [],
+        "words": last_autocompletion.get("words") or [],
         "models": all_models
       })
 
@@ -1061,7 +3729,7 @@ class Connector:
               self.coder.io.encoding,
               self.coder.abs_read_only_fnames
             )
-            await self.send_action({
+            await self.send_context_action("autocompletion", {
               "action": "update-autocompletion",
               "words": tokenized_words,
               "models": all_models
@@ -1084,23 +3752,121 @@ class Connector:
         "models": sorted(set(models.fuzzy_match_models("") + [model_settings.name for model_settings in models.MODEL_SETTINGS]))
       })
 
+  async def get_repo_map(self, coder, chat_files, other_files):
+    if not coder.repo_map:
+      return None
+
+    if self.repo_map_worker:
+      try:
+        return await self.repo_map_worker.get_repo_map(coder.repo_map, coder.main_model, chat_files, other_files)
+      except Exception as e:
+        self.coder.io.tool_warning(f"Repo map worker failed, building repo map in process: {str(e)}")
+        self.repo_map_worker.shutdown()
+
+    if self.repo_map_budget:
+      # keep the event loop responsive while the map is built
+      return await asyncio.to_thread(self.get_repo_map_serialized, coder.repo_map, chat_files, other_files)
+    return coder.repo_map.get_repo_map(chat_files, other_files)
+
+  @staticmethod
+  def get_repo_map_serialized(repo_map, chat_files, other_files):
+    # RepoMap caches are not thread safe, builds for different files must not overlap
+    lock = repo_map.__dict__.setdefault("connector_lock", threading.Lock())
+    with lock:
+      return repo_map.get_repo_map(chat_files, other_files)
+
+  @staticmethod
+  def get_repo_map_key(coder, chat_files, other_files):
+    files = "\0".join(sorted(chat_files)) + "\1" + "\0".join(sorted(other_files))
+    return (
+      coder.main_model.name,
+      coder.repo_map.max_map_tokens,
+      hashlib.sha256(files.encode("utf-8", "surrogatepass")).hexdigest(),
+    )
+
+  async def build_repo_map(self, key, coder, chat_files, other_files):
+    try:
+      repo_map = await self.get_repo_map(coder, chat_files, other_files)
+      self.repo_map_results[key] = repo_map
+      self.repo_map_results.move_to_end(key)
+      while len(self.repo_map_results) > 8:
+        self.repo_map_results.popitem(last=False)
+      return repo_map
+    finally:
+      self.repo_map_tasks.pop(key, None)
+
+  async def get_repo_map_within_budget(self, coder, chat_files, other_files, on_refined):
+    """
+    Returns (repo_map, partial). When the map is not built within the budget, the last map
+    built for the same files, or a list of the files, is returned as partial and on_refined
+    is called with the complete map once it is built.
+    """
+    if not coder.repo_map:
+      return None, False
+    if not self.repo_map_budget:
+      return await self.get_repo_map(coder, chat_files, other_files), False
+
+    chat_files, other_files = set(chat_files), set(other_files)
+    key = self.get_repo_map_key(coder, chat_files, other_files)
+    task = self.repo_map_tasks.get(key)
+    if task is None:
+      task = self.repo_map_tasks[key] = asyncio.ensure_future(self.build_repo_map(key, coder, chat_files, other_files))
+
+    done, _ = await asyncio.wait({task}, timeout=self.repo_map_budget)
+    if done:
+      return task.result(), False
+
+    def refine(finished_task):
+      if not finished_task.cancelled() and finished_task.exception() is None:
+        self.loop.create_task(on_refined(finished_task.result()))
+
+    task.add_done_callback(refine)
+    self.metrics.increment("repo_map_partial")
+    if key in self.repo_map_results:
+      return self.repo_map_results[key], True
+    return self.get_file_list_repo_map(coder, chat_files, other_files), True
+
+  @staticmethod
+  def get_file_list_repo_map(coder, chat_files, other_files):
+    """Repo map listing only the file names, used until the ranked map is built."""
+    repo_map = coder.repo_map
+    max_chars = repo_map.max_map_tokens * 4
+    lines = []
+    size = 0
+    for fname in sorted(coder.get_rel_fname(fname) for fname in other_files):
+      size += len(fname) + 1
+      if size > max_chars:
+        break
+      lines.append(fname)
+    if not lines:
+      return None
+
+    prefix = repo_map.repo_content_prefix.format(other="other " if chat_files else "") if repo_map.repo_content_prefix else ""
+    return prefix + "\n".join(lines) + "\n"
+
   async def send_repo_map(self):
     if self.coder.repo_map:
       try:
-        repo_map = self.coder.repo_map.get_repo_map(set(), self.coder.get_all_abs_files())
-        if repo_map:
-          # Remove the prefix before sending
-          prefix = self.coder.gpt_prompts.repo_content_prefix
-          if repo_map.startswith(prefix):
-            repo_map = repo_map[len(prefix):]
-
-          await self.send_action({
-            "action": "update-repo-map",
-            "repoMap": repo_map
-          })
+        repo_map, partial = await self.get_repo_map_within_budget(self.coder, set(), self.coder.get_all_abs_files(), self.send_repo_map_action)
+        await self.send_repo_map_action(repo_map, partial)
       except Exception as e:
         self.coder.io.tool_error(f"Error sending repo map: {str(e)}")
 
+  async def send_repo_map_action(self, repo_map, partial=False):
+    if repo_map:
+      # Remove the prefix before sending
+      prefix = self.coder.gpt_prompts.repo_content_prefix
+      if repo_map.startswith(prefix):
+        repo_map = repo_map[len(prefix):]
+
+      action = {
+        "action": "update-repo-map",
+        "repoMap": repo_map
+      }
+      if partial:
+        action["partial"] = True
+      await self.send_context_action("repoMap", action)
+
   def get_context_files(self, coder=None):
     if not coder:
       coder = self.coder
@@ -1127,8 +3893,26 @@ class Connector:
       "content": content
     })
 
+  async def send_add_context_messages(self, messages):
+    if len(messages) > 1 and self.has_capability("add-messages"):
+      await self.send_action({
+        "action": "add-messages",
+        "messages": messages
+      })
+      return
+
+    for message in messages:
+      await self.send_add_context_message(message["role"], message["content"])
+
   async def send_add_context_files(self, coder=None):
     context_files = self.get_context_files(coder)
+    if len(context_files) > 1 and self.has_capability("add-files"):
+      await self.send_action({
+        "action": "add-files",
+        "files": context_files
+      })
+      return
+
     for file in context_files:
       await self.send_action({
         "action": "add-file",
@@ -1138,10 +3922,10 @@ class Connector:
 
   async def send_update_context_files(self, coder=None):
     context_files = self.get_context_files(coder)
-    await self.sio.emit("message", {
+    await self.send_action({
       "action": "update-context-files",
       "files": context_files
-    })
+    }, False)
 
   async def send_current_models(self):
     error = None
@@ -1170,28 +3954,14 @@ class Connector:
     self.coder.choose_fence()
 
     # system messages
-    main_sys = self.coder.fmt_system_prompt(self.coder.gpt_prompts.main_system)
-    main_sys += "\n" + self.coder.fmt_system_prompt(self.coder.gpt_prompts.system_reminder)
-    msgs = [
-      dict(role="system", content=main_sys),
-      dict(
-        role="system",
-        content=self.coder.fmt_system_prompt(self.coder.gpt_prompts.system_reminder),
-      ),
-    ]
-    tokens = self.coder.main_model.token_count(msgs)
+    tokens = self.token_accounting.count_system_prompt(self.coder)
     info["systemMessages"] = {
       "tokens": tokens,
       "cost": tokens * cost_per_token,
     }
 
-    # Convert messages to the format expected by token_count
-    msgs = [dict(role=msg['role'], content=msg['content']) for msg in messages]
-
-    if msgs:
-      tokens = self.coder.main_model.token_count(msgs)
-    else:
-      tokens = 0
+    # only the messages not counted before are tokenized
+    tokens = self.token_accounting.count_messages(self.coder.main_model, messages)
     info["chatHistory"] = {
       "tokens": tokens,
       "cost": tokens * cost_per_token,
@@ -1214,20 +3984,24 @@ class Connector:
     all_abs_files = self.coder.get_all_abs_files()
     other_files = set(all_abs_files) - abs_fnames
 
-    if self.coder.repo_map:
-      repo_content = self.coder.repo_map.get_repo_map(abs_fnames, other_files)
-      if repo_content:
-        tokens = self.coder.main_model.token_count(repo_content)
-      else:
-        tokens = 0
+    async def refine_repo_map_tokens(refined_repo_map):
+      await self.refine_repo_map_tokens(refined_repo_map, cost_per_token)
+
+    repo_content, partial = await self.get_repo_map_within_budget(self.coder, abs_fnames, other_files, refine_repo_map_tokens)
+    if repo_content:
+      tokens = self.coder.main_model.token_count(repo_content)
     else:
       tokens = 0
     info["repoMap"] = {
       "tokens": tokens,
       "cost": tokens * cost_per_token,
     }
+    if partial:
+      info["repoMap"]["partial"] = True
 
     fence = "`" * 3
+    # large files with estimated tokens, refined after the info is sent
+    estimated_files = []
 
     # Process the provided context files
     for file in files:
@@ -1240,21 +4014,105 @@ class Connector:
         continue
 
       relative_fname = self.coder.get_rel_fname(file_path)
-      content = self.coder.io.read_text(file_path)
       if is_image_file(relative_fname):
         tokens = self.coder.main_model.token_count_for_image(file_path)
-      elif content is not None:
-        # approximate
-        content = f"{relative_fname}\n{fence}\n" + content + "{fence}\n"
-        tokens = self.coder.main_model.token_count(content)
+      elif self.file_token_estimator.is_large_file(file_path):
+        file_info = await self.get_large_file_tokens_info(file_path, relative_fname, fence, cost_per_token, estimated_files)
+        if file_info:
+          info["files"][relative_fname] = file_info
+        continue
       else:
-        tokens = 0
+        content = self.coder.io.read_text(file_path)
+        if content is not None:
+          # approximate
+          content = f"{relative_fname}\n{fence}\n" + content + "{fence}\n"
+          tokens = self.coder.main_model.token_count(content)
+        else:
+          tokens = 0
       info["files"][relative_fname] = {
         "tokens": tokens,
         "cost": tokens * cost_per_token,
       }
 
-    await self.send_action({
+    await self.send_context_action("tokensInfo", {
+      "action": "tokens-info",
+      "info": info
+    })
+
+    if estimated_files:
+      self.loop.create_task(self.refine_estimated_tokens(estimated_files, cost_per_token))
+
+  async def get_large_file_tokens_info(self, file_path, relative_fname, fence, cost_per_token, estimated_files):
+    model = self.coder.main_model
+    encoding = self.coder.io.encoding
+    wrapper_tokens = model.token_count(f"{relative_fname}\n{fence}\n" + "{fence}\n")
+
+    try:
+      key = FileTokenEstimator.get_key(file_path, model)
+      exact = self.file_token_estimator.get_exact(key)
+      if exact is not None:
+        tokens = exact + wrapper_tokens
+        return {"tokens": tokens, "cost": tokens * cost_per_token}
+
+      tokens, (low, high) = await asyncio.to_thread(self.file_token_estimator.estimate, file_path, model, encoding)
+    except OSError as e:
+      self.coder.io.tool_error(f"{relative_fname}: unable to read: {str(e)}")
+      return None
+
+    estimated_files.append((relative_fname, key, model, encoding, wrapper_tokens))
+    tokens += wrapper_tokens
+    return {
+      "tokens": tokens,
+      "cost": tokens * cost_per_token,
+      "estimated": True,
+      "tokensRange": [low + wrapper_tokens, high + wrapper_tokens],
+    }
+
+  async def refine_estimated_tokens(self, estimated_files, cost_per_token):
+    """Counts the estimated files exactly and pushes corrected tokens info."""
+    exact_files = {}
+    for relative_fname, key, model, encoding, wrapper_tokens in estimated_files:
+      try:
+        tokens = await asyncio.to_thread(self.file_token_estimator.count_exact, key, model, encoding)
+      except OSError:
+        continue
+      exact_files[relative_fname] = tokens + wrapper_tokens
+
+    # update the latest tokens info, newer one could have been sent in the meantime
+    last_action = self.context_snapshot.get("tokensInfo")
+    if not last_action or not exact_files:
+      return
+
+    info = dict(last_action["info"])
+    info["files"] = dict(info["files"])
+    for relative_fname, tokens in exact_files.items():
+      file_info = info["files"].get(relative_fname)
+      if file_info and file_info.get("estimated"):
+        info["files"][relative_fname] = {
+          "tokens": tokens,
+          "cost": tokens * cost_per_token,
+        }
+
+    await self.send_context_action("tokensInfo", {
+      "action": "tokens-info",
+      "info": info
+    })
+
+  async def refine_repo_map_tokens(self, repo_map, cost_per_token):
+    """Pushes tokens info with the tokens of the complete repo map."""
+    # update the latest tokens info, newer one could have been sent in the meantime
+    last_action = self.context_snapshot.get("tokensInfo")
+    if not last_action or not last_action["info"].get("repoMap", {}).get("partial"):
+      return
+
+    tokens = self.coder.main_model.token_count(repo_map) if repo_map else 0
+    info = dict(last_action["info"])
+    info["repoMap"] = {
+      "tokens": tokens,
+      "cost": tokens * cost_per_token,
+    }
+
+    await self.send_context_action("tokensInfo", {
       "action": "tokens-info",
       "info": info
     })
@@ -1276,6 +4134,33 @@ def main(argv=None):
     server_url = os.getenv("CONNECTOR_SERVER_URL", "http://localhost:24337")
     base_dir = os.getenv("BASE_DIR", os.getcwd())
     confirm_before_edit = os.getenv("CONNECTOR_CONFIRM_BEFORE_EDIT", "0") == "1"
+    memory_budget_mb = int(os.getenv("CONNECTOR_MEMORY_BUDGET_MB", "0"))
+    repo_map_processes = int(os.getenv("CONNECTOR_REPO_MAP_PROCESSES", "0"))
+    cache_dir = os.getenv("CONNECTOR_CACHE_DIR")
+    async_commit_messages = os.getenv("CONNECTOR_ASYNC_COMMIT_MESSAGES", "0") == "1"
+    command_output_max_tokens = int(os.getenv("CONNECTOR_COMMAND_OUTPUT_MAX_TOKENS", "8000"))
+    command_output_buffer_kb = int(os.getenv("CONNECTOR_COMMAND_OUTPUT_BUFFER_KB", "1024"))
+    resume_grace_period = float(os.getenv("CONNECTOR_RESUME_GRACE_PERIOD", "0"))
+    repo_map_budget_ms = int(os.getenv("CONNECTOR_REPO_MAP_BUDGET_MS", "0"))
+    llm_cache_mb = int(os.getenv("CONNECTOR_LLM_CACHE_MB", "0"))
+    summarize_history_tokens = int(os.getenv("CONNECTOR_SUMMARIZE_HISTORY_TOKENS", "0"))
+    prompt_batch_concurrency = int(os.getenv("CONNECTOR_PROMPT_BATCH_CONCURRENCY", "4"))
+    transport = create_transport(
+      os.getenv("CONNECTOR_TRANSPORT", "socketio"),
+      server_url=server_url,
+      socket_path=os.getenv("CONNECTOR_SOCKET_PATH"),
+      headless_options={
+        "input_path": os.getenv("CONNECTOR_HEADLESS_INPUT", "-"),
+        "output_path": os.getenv("CONNECTOR_HEADLESS_OUTPUT", "-"),
+        "answer": os.getenv("CONNECTOR_HEADLESS_ANSWER"),
+        "sequential": os.getenv("CONNECTOR_HEADLESS_SEQUENTIAL", "0") == "1",
+      }
+    )
+    http_pool_options = False if os.getenv("CONNECTOR_HTTP_POOL", "0") != "1" else {
+      "keepalive_expiry": float(os.getenv("CONNECTOR_HTTP_KEEPALIVE_SECONDS", "120")),
+      "max_connections": int(os.getenv("CONNECTOR_HTTP_MAX_CONNECTIONS", "20")),
+      "http2": os.getenv("CONNECTOR_HTTP2", "1") == "1",
+    }
 
     # Telemetry
     setup_telemetry()
@@ -1287,7 +4172,20 @@ def main(argv=None):
       server_url=server_url,
       reasoning_effort=args.reasoning_effort,
       thinking_tokens=args.thinking_tokens,
-      confirm_before_edit=confirm_before_edit
+      confirm_before_edit=confirm_before_edit,
+      memory_budget=memory_budget_mb * 1024 * 1024 if memory_budget_mb > 0 else None,
+      repo_map_processes=repo_map_processes,
+      cache_dir=cache_dir,
+      async_commit_messages=async_commit_messages,
+      command_output_max_tokens=command_output_max_tokens if command_output_max_tokens > 0 else None,
+      command_output_buffer_size=command_output_buffer_kb * 1024,
+      resume_grace_period=resume_grace_period if resume_grace_period > 0 else None,
+      repo_map_budget=repo_map_budget_ms / 1000 if repo_map_budget_ms > 0 else None,
+      http_pool_options=http_pool_options,
+      llm_cache_size=llm_cache_mb * 1024 * 1024 if llm_cache_mb > 0 else None,
+      summarize_history_tokens=summarize_history_tokens if summarize_history_tokens > 0 else None,
+      transport=transport,
+      prompt_batch_concurrency=prompt_batch_concurrency
     )
 
     # Start the connector